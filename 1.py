@@ -39,12 +39,27 @@ def extract_audio_from_video(video_path: str, audio_output_path: str):
         # --- END ADDITION ---
         return False
 
-def transcribe_audio(audio_path: str, cfg: Config) -> str:
+def load_whisper_model(cfg: Config):
+    return whisper.load_model(cfg.WHISPER_MODEL_NAME, device=cfg.DEVICE, download_root=str(cfg.WHISPER_MODEL_PATH))
+
+def load_translation_model(cfg: Config):
+    tokenizer = AutoTokenizer.from_pretrained(cfg.TRANSLATION_MODEL_PATH, use_fast=False)
+    model = AutoModelForSeq2SeqLM.from_pretrained(cfg.TRANSLATION_MODEL_PATH).to(cfg.DEVICE)
+    return tokenizer, model
+
+def load_tts_model(cfg: Config):
+    tokenizer = AutoTokenizer.from_pretrained(cfg.TTS_MODEL_PATH)
+    model = VitsModel.from_pretrained(cfg.TTS_MODEL_PATH).to(cfg.DEVICE)
+    return tokenizer, model
+
+def transcribe_audio(audio, cfg: Config, model=None) -> str:
+    """`audio` is a file path or a 16 kHz mono float32 array; pass `model` to reuse a loaded Whisper."""
     print(f"\n[STEP 2/4] 🎤 Transcribing audio with Whisper ({cfg.WHISPER_MODEL_NAME})...")
     start_time = time.time()
     try:
-        model = whisper.load_model(cfg.WHISPER_MODEL_NAME, device=cfg.DEVICE, download_root=str(cfg.WHISPER_MODEL_PATH))
-        result = model.transcribe(audio_path, fp16=torch.cuda.is_available())
+        if model is None:
+            model = load_whisper_model(cfg)
+        result = model.transcribe(audio, fp16=torch.cuda.is_available())
         transcribed_text = result["text"].strip()
         duration = time.time() - start_time
         print(f"Transcription complete in {duration:.2f}s.")
@@ -59,12 +74,11 @@ def transcribe_audio(audio_path: str, cfg: Config) -> str:
         # --- END ADDITION ---
         return None
 
-def translate_text(text_to_translate: str, cfg: Config) -> str:
+def translate_text(text_to_translate: str, cfg: Config, models=None) -> str:
     print(f"\n[STEP 3/4] 🌐 Translating text from '{cfg.SRC_LANG}' to '{cfg.TGT_LANG}'...")
     start_time = time.time()
     try:
-        tokenizer = AutoTokenizer.from_pretrained(cfg.TRANSLATION_MODEL_PATH, use_fast=False)
-        model = AutoModelForSeq2SeqLM.from_pretrained(cfg.TRANSLATION_MODEL_PATH).to(cfg.DEVICE)
+        tokenizer, model = models if models is not None else load_translation_model(cfg)
 
         tokenizer.src_lang = cfg.SRC_LANG
         inputs = tokenizer(text_to_translate, return_tensors="pt").to(cfg.DEVICE)
@@ -89,12 +103,12 @@ def translate_text(text_to_translate: str, cfg: Config) -> str:
         # --- END ADDITION ---
         return None
 
-def synthesize_speech(text_to_speak: str, output_path: str, cfg: Config):
-    print(f"\n[STEP 4/4] 🎵 Synthesizing speech to '{output_path}'...")
+def synthesize_waveform(text_to_speak: str, cfg: Config, models=None):
+    """Returns `(speech_array, sample_rate)`, or None if synthesis failed."""
+    print(f"\n[STEP 4/4] 🎵 Synthesizing speech...")
     start_time = time.time()
     try:
-        tokenizer = AutoTokenizer.from_pretrained(cfg.TTS_MODEL_PATH)
-        model = VitsModel.from_pretrained(cfg.TTS_MODEL_PATH).to(cfg.DEVICE)
+        tokenizer, model = models if models is not None else load_tts_model(cfg)
 
         inputs = tokenizer(text_to_speak, return_tensors="pt").to(cfg.DEVICE)
 
@@ -103,11 +117,9 @@ def synthesize_speech(text_to_speak: str, output_path: str, cfg: Config):
 
         speech_array = output.squeeze().cpu().numpy()
         sample_rate = model.config.sampling_rate
-
-        scipy.io.wavfile.write(output_path, rate=sample_rate, data=speech_array)
         duration = time.time() - start_time
         print(f"✅ Speech synthesized successfully in {duration:.2f}s.")
-        return True
+        return speech_array, sample_rate
     except Exception as e:
         print(f"❌ ERROR during speech synthesis: {e}")
         # --- ADDED: Print full traceback for detailed debugging ---
@@ -115,7 +127,16 @@ def synthesize_speech(text_to_speak: str, output_path: str, cfg: Config):
         traceback.print_exc()
         print("----------------------\n")
         # --- END ADDITION ---
+        return None
+
+def synthesize_speech(text_to_speak: str, output_path: str, cfg: Config, models=None):
+    synthesized = synthesize_waveform(text_to_speak, cfg, models)
+    if synthesized is None:
         return False
+    speech_array, sample_rate = synthesized
+    scipy.io.wavfile.write(output_path, rate=sample_rate, data=speech_array)
+    print(f"   -> Speech written to '{output_path}'.")
+    return True
 
 
 def main():
@@ -0,0 +1,158 @@
+import os, tempfile, traceback, warnings
+import numpy as np
+import torch
+import torch.nn.functional as F
+import faiss
+
+# Feature matrices up to this size are kept on the conversion device and searched there with torch;
+# larger ones are searched with FAISS on the host.
+DEVICE_MAX_BYTES = 2 << 30
+# Size of one (queries x features) distance block of the torch search.
+SEARCH_BLOCK_BYTES = 256 << 20
+
+# Loaded indexes, keyed by absolute path; an entry is reused while the file's size and mtime match.
+_loaded = {}
+
+
+class FeatureIndex:
+    """A FAISS retrieval index and the feature matrix it was built from.
+
+    The index is read memory-mapped. The features (`reconstruct_n(0, ntotal)`) are written once to a
+    `<index>.features.npy` sidecar and memory-mapped from there, so later runs and other worker
+    processes share the same pages instead of each rebuilding a private copy.
+    """
+
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        self.stat = os.stat(self.path)
+        try:
+            self.index = faiss.read_index(self.path, faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY)
+        except RuntimeError:
+            # Not every index type can be mapped; read it into memory instead.
+            self.index = faiss.read_index(self.path)
+        self.ntotal = self.index.ntotal
+        self.sidecar_path = self.path + ".features.npy"
+        self._big_npy = None
+        self._device_features = {}  # device -> (features, squared norms)
+
+    @property
+    def big_npy(self):
+        if self._big_npy is None:
+            self._big_npy = self._load_sidecar()
+            if self._big_npy is None:
+                big_npy = self.index.reconstruct_n(0, self.ntotal)
+                self._big_npy = self._save_sidecar(big_npy)
+        return self._big_npy
+
+    def _load_sidecar(self):
+        try:
+            if os.stat(self.sidecar_path).st_mtime_ns < self.stat.st_mtime_ns:
+                return None  # older than the index it was built from
+            big_npy = np.load(self.sidecar_path, mmap_mode="r")
+        except (OSError, ValueError):
+            return None
+        return big_npy if big_npy.shape[0] == self.ntotal else None
+
+    def _save_sidecar(self, big_npy):
+        """Writes the sidecar atomically and returns it memory-mapped; `big_npy` itself if that fails."""
+        tmp_path = None
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(self.sidecar_path), suffix=".tmp")
+            with os.fdopen(fd, "wb") as f:
+                np.save(f, np.ascontiguousarray(big_npy, dtype=np.float32))
+            # mkstemp creates the file 0600; give the sidecar the index's permissions instead.
+            os.chmod(tmp_path, self.stat.st_mode & 0o777)
+            os.replace(tmp_path, self.sidecar_path)
+            return np.load(self.sidecar_path, mmap_mode="r")
+        except OSError:
+            traceback.print_exc()
+            if tmp_path is not None and os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return big_npy
+
+    def search(self, x, k=8):
+        return self.index.search(x, k)
+
+    def searches_on_device(self, device):
+        """Whether `blend` runs in torch on `device`.
+
+        That needs the features to fit in DEVICE_MAX_BYTES. On the CPU it is only used for exact
+        (flat L2) indexes, where it gives the same neighbours as FAISS; an approximate index
+        (IVF, HNSW, ...) chosen for CPU speed stays in FAISS. On a GPU the torch search is exact
+        for every index type.
+        """
+        if self.index.metric_type != faiss.METRIC_L2 or self.ntotal * self.index.d * 4 > DEVICE_MAX_BYTES:
+            return False
+        return str(device) != "cpu" or isinstance(self.index, faiss.IndexFlat)
+
+    def device_features(self, device):
+        key = str(device)
+        if key not in self._device_features:
+            with warnings.catch_warnings():
+                # The read-only memory map is shared as is on the CPU; it is never written to.
+                warnings.simplefilter("ignore", UserWarning)
+                features = torch.from_numpy(np.ascontiguousarray(self.big_npy, dtype=np.float32)).to(device)
+            self._device_features[key] = (features, features.square().sum(1))
+        return self._device_features[key]
+
+    def blend(self, feats, index_rate, k=8):
+        """Mixes `index_rate` of the retrieved features into the (1, T, C) HuBERT `feats`.
+
+        Each frame is replaced by the inverse-square-distance weighted mean of its `k` nearest
+        training features. When searches_on_device is true this stays on the device of `feats`:
+        a blocked squared-L2 top-k plus one embedding_bag for the weighted sum, so there is no
+        host round trip and no (T, k, C) gather.
+        """
+        if self.searches_on_device(feats.device):
+            features, sq_norms = self.device_features(feats.device)
+            queries = feats[0].float()
+            block = max(1, SEARCH_BLOCK_BYTES // (4 * self.ntotal))
+            retrieved = []
+            for start in range(0, len(queries), block):
+                q = queries[start : start + block]
+                # Squared L2 distances as FAISS computes them for flat indexes.
+                dist = torch.addmm(sq_norms.unsqueeze(0), q, features.t(), alpha=-2)
+                dist = (dist + q.square().sum(1, keepdim=True)).clamp_(min=0)
+                score, ix = torch.topk(dist, k, dim=1, largest=False)
+                weight = 1 / score.square()
+                weight /= weight.sum(1, keepdim=True)
+                retrieved.append(F.embedding_bag(ix, features, per_sample_weights=weight, mode="sum"))
+            retrieved = torch.cat(retrieved).unsqueeze(0)
+        else:
+            npy = feats[0].float().cpu().numpy()
+            score, ix = self.index.search(npy, k=k)
+            weight = np.square(1 / score)
+            weight /= weight.sum(axis=1, keepdims=True)
+            npy = np.sum(self.big_npy[ix] * np.expand_dims(weight, axis=2), axis=1)
+            retrieved = torch.from_numpy(npy).unsqueeze(0).to(feats.device)
+        return retrieved.to(feats.dtype) * index_rate + (1 - index_rate) * feats
+
+
+def set_search_params(index, nprobe=0, ef_search=0):
+    """Sets nprobe (IVF) and efSearch (HNSW) where they apply; 0 keeps the current value."""
+    params = faiss.ParameterSpace()
+    if nprobe and faiss.try_extract_index_ivf(index) is not None:
+        params.set_index_parameter(index, "nprobe", nprobe)
+    if ef_search and hasattr(faiss.downcast_index(index), "hnsw"):
+        params.set_index_parameter(index, "efSearch", ef_search)
+
+
+def describe(index):
+    ivf = faiss.try_extract_index_ivf(index)
+    index = faiss.downcast_index(index)
+    if ivf is not None:
+        return f"{type(index).__name__} nlist={ivf.nlist} nprobe={ivf.nprobe}"
+    if hasattr(index, "hnsw"):
+        return f"{type(index).__name__} efSearch={index.hnsw.efSearch}"
+    return type(index).__name__
+
+
+def load_index(path):
+    """Returns the FeatureIndex for `path`, reading the file only the first time (or after it changed)."""
+    key = os.path.abspath(path)
+    stat = os.stat(key)
+    cached = _loaded.get(key)
+    if cached is not None and (cached.stat.st_size, cached.stat.st_mtime_ns) == (stat.st_size, stat.st_mtime_ns):
+        return cached
+    _loaded[key] = FeatureIndex(key)
+    return _loaded[key]
@@ -0,0 +1,134 @@
+"""Builds approximate versions of an RVC feature index and benchmarks their recall against latency.
+
+    python index_tool.py convert weights/model.index weights/model_ivfpq.index --type ivfpq --nprobe 16
+    python index_tool.py convert weights/model.index weights/model_hnsw.index --type hnsw --ef_search 64
+    python index_tool.py benchmark weights/model.index weights/model_ivfpq.index weights/model_hnsw.index
+
+The converted index stores its nprobe/efSearch, so `my_convert.py --index` takes it as is; the
+exact training features are kept next to it as the `.features.npy` sidecar used for blending.
+"""
+import argparse, os, time
+import numpy as np
+import faiss
+from feature_index import describe, load_index, set_search_params
+
+TYPES = ("ivfflat", "ivfpq", "hnsw")
+
+
+def default_nlist(n):
+    # FAISS guideline of ~4*sqrt(n) lists, with at least 39 training points per list.
+    return int(max(1, min(4 * np.sqrt(n), n // 39)))
+
+
+def build_index(features, index_type, nlist=0, pq_m=0, pq_bits=8, hnsw_m=32, ef_construction=40):
+    """Trains and fills an `index_type` L2 index over `features` ((N, d) float32)."""
+    n, d = features.shape
+    if index_type == "hnsw":
+        index = faiss.IndexHNSWFlat(d, hnsw_m)
+        index.hnsw.efConstruction = ef_construction
+    else:
+        quantizer = faiss.IndexFlatL2(d)
+        nlist = nlist or default_nlist(n)
+        if index_type == "ivfpq":
+            pq_m = pq_m or d // 8
+            if not pq_m or d % pq_m:
+                raise ValueError(f"--pq_m {pq_m} must divide the feature dimension {d}")
+            index = faiss.IndexIVFPQ(quantizer, d, nlist, pq_m, pq_bits)
+        else:
+            index = faiss.IndexIVFFlat(quantizer, d, nlist)
+        index.train(features)
+    index.add(features)
+    return index
+
+
+def convert(args):
+    source = load_index(args.input)
+    features = np.ascontiguousarray(source.big_npy, dtype=np.float32)
+    start = time.time()
+    index = build_index(features, args.type, args.nlist, args.pq_m, args.pq_bits, args.hnsw_m, args.ef_construction)
+    set_search_params(index, args.nprobe, args.ef_search)
+    faiss.write_index(index, args.output)
+    # Written after the index, so load_index takes it as current: blending uses the exact features.
+    np.save(args.output + ".features.npy", features)
+    print(f"{describe(index)}: {index.ntotal} vectors in {time.time() - start:.1f}s, "
+          f"{os.path.getsize(args.input) / 2**20:.1f} MB -> {os.path.getsize(args.output) / 2**20:.1f} MB")
+
+
+def sample_queries(features, n, noise, seed=0):
+    """Training features perturbed by `noise` times the per-dimension std, like unseen HuBERT frames."""
+    rng = np.random.default_rng(seed)
+    rows = features[np.sort(rng.choice(len(features), size=min(n, len(features)), replace=False))]
+    return (rows + noise * features.std(0) * rng.standard_normal(rows.shape)).astype(np.float32)
+
+
+def timed_search(index, queries, k, repeats):
+    index.search(queries[:64], k)  # warm-up
+    best, result = float("inf"), None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = index.search(queries, k)[1]
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def benchmark(args):
+    reference = load_index(args.indexes[0])
+    features = np.ascontiguousarray(reference.big_npy, dtype=np.float32)
+    queries = sample_queries(features, args.queries, args.noise)
+    exact = faiss.IndexFlatL2(features.shape[1])
+    exact.add(features)
+    _, truth = exact.search(queries, args.k)
+
+    print(f"{len(queries)} queries, k={args.k}, recall@{args.k} against exact search over {len(features)} vectors")
+    print(f"{'index':<40} {'setting':<28} {'recall':>7} {'ms/1k frames':>13}")
+    for path in args.indexes:
+        index = load_index(path).index
+        ivf = faiss.try_extract_index_ivf(index)
+        if ivf is not None:
+            settings = [("nprobe", v) for v in args.nprobe if v <= ivf.nlist]
+        elif hasattr(faiss.downcast_index(index), "hnsw"):
+            settings = [("ef_search", v) for v in args.ef_search]
+        else:
+            settings = [(None, None)]
+        for name, value in settings:
+            if name is not None:
+                set_search_params(index, **{name: value})
+            seconds, found = timed_search(index, queries, args.k, args.repeats)
+            recall = np.mean([len(np.intersect1d(a, b)) for a, b in zip(found, truth)]) / args.k
+            setting = f"{name}={value}" if name else "exact"
+            print(f"{os.path.basename(path):<40} {setting:<28} {recall:>7.3f} {1000 * seconds / len(queries) * 1000:>13.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Approximate RVC feature indexes")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("convert", help="Build an IVF/PQ or HNSW index from an existing .index")
+    p.add_argument("input", help="Source .index (any type that supports reconstruct_n).")
+    p.add_argument("output", help="Path of the new .index.")
+    p.add_argument("--type", choices=TYPES, default="ivfpq", help="Index structure to build.")
+    p.add_argument("--nlist", type=int, default=0, help="IVF lists (0 = 4*sqrt(N)).")
+    p.add_argument("--pq_m", type=int, default=0, help="PQ sub-quantizers; must divide the feature dimension (0 = d/8).")
+    p.add_argument("--pq_bits", type=int, default=8, help="Bits per PQ code.")
+    p.add_argument("--hnsw_m", type=int, default=32, help="HNSW neighbours per node.")
+    p.add_argument("--ef_construction", type=int, default=40, help="HNSW build-time search depth.")
+    p.add_argument("--nprobe", type=int, default=16, help="IVF lists searched per query, stored in the index.")
+    p.add_argument("--ef_search", type=int, default=64, help="HNSW search depth, stored in the index.")
+    p.set_defaults(run=convert)
+
+    p = sub.add_parser("benchmark", help="Recall against latency of one or more indexes")
+    p.add_argument("indexes", nargs="+", help="Indexes to compare; the first one provides the features and ground truth.")
+    p.add_argument("--queries", type=int, default=2000, help="Number of query frames.")
+    p.add_argument("--noise", type=float, default=0.1, help="Query perturbation, in feature standard deviations.")
+    p.add_argument("--k", type=int, default=8, help="Neighbours per query (VC.vc uses 8).")
+    p.add_argument("--nprobe", type=int, nargs="+", default=[1, 4, 8, 16, 32, 64], help="nprobe values for IVF indexes.")
+    p.add_argument("--ef_search", type=int, nargs="+", default=[16, 32, 64, 128, 256], help="efSearch values for HNSW indexes.")
+    p.add_argument("--repeats", type=int, default=3, help="Timed runs per setting; the fastest is reported.")
+    p.set_defaults(run=benchmark)
+
+    args = parser.parse_args()
+    args.run(args)
+
+
+if __name__ == "__main__":
+    main()
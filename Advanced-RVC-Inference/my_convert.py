@@ -5,6 +5,7 @@ import warnings
 from contextlib import contextmanager
 from fairseq import checkpoint_utils
 from vc_infer_pipeline import VC
+from feature_index import describe, load_index, set_search_params
 from config import Config
 import fairseq.data
 torch.serialization.add_safe_globals([fairseq.data.dictionary.Dictionary])
@@ -15,7 +16,11 @@ warnings.filterwarnings("ignore", category=UserWarning)
 
 @contextmanager
 def suppress_stdout_stderr():
-    """A context manager that redirects stdout and stderr to devnull"""
+    """A context manager that redirects stdout and stderr to devnull.
+
+    The redirect is process-wide, so it also silences (and, when used from several threads at
+    once, breaks) every other thread's output; only use it from single-threaded code.
+    """
     with open(os.devnull, 'w') as fnull:
         old_stdout, old_stderr = sys.stdout, sys.stderr
         sys.stdout, sys.stderr = fnull, fnull
@@ -23,6 +28,62 @@ def suppress_stdout_stderr():
             yield
         finally:
             sys.stdout, sys.stderr = old_stdout, old_stderr
+
+def load_hubert(path, config):
+    models, _, _ = checkpoint_utils.load_model_ensemble_and_task([path])
+    hubert_model = models[0].to(config.device)
+    hubert_model.eval()
+    return hubert_model
+
+def load_voice_model(vc_pipeline, model_path):
+    """Returns `(net_g, model_sr, version)` for an RVC generator checkpoint."""
+    cpt = torch.load(model_path, map_location="cpu")
+
+    # --- DETERMINE SAMPLE RATE ---
+    model_sr = cpt.get("sr")
+    if model_sr:
+        model_sr = int(str(model_sr).replace("k", "")) * 1000 if "k" in str(model_sr) else int(model_sr)
+    else: # Fallback if sr is not in the checkpoint
+        model_sr = 48000
+
+    version = cpt.get("version", "v1")
+    with suppress_stdout_stderr():
+        net_g = vc_pipeline.get_vc(cpt, version)
+    return net_g, model_sr, version
+
+def convert(vc_pipeline, hubert_model, net_g, audio, model_sr, version, input_audio_path="",
+            index="", pitch=0, f0_method="rmvpe", index_rate=0.7, filter_radius=3,
+            resample_sr=0, rms_mix_rate=1.0, protect=0.33, batch_chunks=1, workers=0):
+    """Converts a 16 kHz mono float array; returns `(int16 audio, output_sr)`.
+
+    `batch_chunks` > 1 runs up to that many chunks of a long input through the models at once;
+    `workers` > 1 converts the chunks in that many forked processes when running on the CPU and
+    this is the only thread of the process (see VC.pipeline).
+    """
+    output_sr = resample_sr if resample_sr > 0 else model_sr
+    out_audio = vc_pipeline.pipeline(
+        model=hubert_model,
+        net_g=net_g,
+        sid=0,
+        audio=audio,
+        input_audio_path=input_audio_path,
+        times=[0,0,0],
+        f0_up_key=pitch,
+        f0_method=f0_method,
+        file_index=index,
+        index_rate=index_rate,
+        if_f0=1,
+        filter_radius=filter_radius,
+        tgt_sr=model_sr,
+        resample_sr=output_sr,
+        rms_mix_rate=rms_mix_rate,
+        version=version,
+        protect=protect,
+        batch_chunks=batch_chunks,
+        workers=workers,
+    )
+    return out_audio, output_sr
+
 def main():
     # --- ARGS ---
     parser = argparse.ArgumentParser(description="RVC Voice Conversion")
@@ -32,11 +93,15 @@ def main():
     parser.add_argument("--index", type=str, default="", help="Path to the .index feature file. (Optional)")
     parser.add_argument("--pitch", type=int, default=0, help="Transpose pitch in semitones.")
     parser.add_argument("--f0_method", type=str, default="rmvpe", choices=["pm", "harvest", "crepe", "rmvpe"], help="Pitch extraction method.")
+    parser.add_argument("--nprobe", type=int, default=0, help="IVF lists searched per query (0 = as stored in the index).")
+    parser.add_argument("--ef_search", type=int, default=0, help="HNSW search depth (0 = as stored in the index).")
     parser.add_argument("--index_rate", type=float, default=0.7, help="Ratio of feature retrieval.")
     parser.add_argument("--filter_radius", type=int, default=3, help="Median filtering radius for pitch.")
     parser.add_argument("--resample_sr", type=int, default=0, help="Output sample rate (0 = keep target sr).")
     parser.add_argument("--rms_mix_rate", type=float, default=1.0, help="Volume envelope mix rate.")
     parser.add_argument("--protect", type=float, default=0.33, help="Protects voiceless consonants.")
+    parser.add_argument("--workers", type=int, default=0, help="CPU only: processes converting chunks in parallel (0/1 = one).")
+    parser.add_argument("--batch_chunks", type=int, default=1, help="Chunks of long inputs converted per batch (1 = one at a time).")
     args = parser.parse_args()
 
     print("=" * 40)
@@ -52,34 +117,23 @@ def main():
         # --- LOAD HUBERT ---
         print("-> [1/5] Loading Hubert model...")
         with suppress_stdout_stderr():
-            models, _, _ = checkpoint_utils.load_model_ensemble_and_task(["hubert_base.pt"])
-            hubert_model = models[0].to(config.device)
-            hubert_model.eval()
+            hubert_model = load_hubert("hubert_base.pt", config)
         print("   - Hubert model loaded.")
 
         # --- LOAD VOICE MODEL ---
         print(f"-> [2/5] Loading voice model: {os.path.basename(args.model)}")
-        cpt = torch.load(args.model, map_location="cpu")
-        
-        # --- DETERMINE SAMPLE RATE ---
-        model_sr = cpt.get("sr")
-        if model_sr:
-            model_sr = int(str(model_sr).replace("k", "")) * 1000 if "k" in str(model_sr) else int(model_sr)
-        else: # Fallback if sr is not in the checkpoint
-            model_sr = 48000
-        
-        version = cpt.get("version", "v1")
+        net_g, model_sr, version = load_voice_model(vc_pipeline, args.model)
         print(f"   - Voice model loaded (Version: {version}, SR: {model_sr}Hz).")
-        
-        with suppress_stdout_stderr():
-            net_g = vc_pipeline.get_vc(cpt, version)
 
         # --- LOAD FAISS INDEX (if provided) ---
         if args.index and os.path.exists(args.index):
             print(f"-> [3/5] Loading FAISS index...")
-            from faiss import read_index
-            index = read_index(args.index)
-            print(f"   - FAISS index loaded (Entries: {index.ntotal}).")
+            # VC.pipeline reuses this load instead of reading the file again.
+            index = load_index(args.index)
+            index.big_npy  # builds or maps the feature sidecar
+            set_search_params(index.index, args.nprobe, args.ef_search)
+            print(f"   - FAISS index loaded ({describe(index.index)}, Entries: {index.ntotal}, "
+                  f"features: {os.path.basename(index.sidecar_path)}).")
         else:
             print("-> [3/5] No FAISS index provided, skipping.")
 
@@ -92,29 +146,23 @@ def main():
         # --- RUN INFERENCE PIPELINE ---
         print("-> [5/5] Performing voice conversion...")
         with suppress_stdout_stderr():
-            out_audio = vc_pipeline.pipeline(
-                model=hubert_model,
-                net_g=net_g,
-                sid=0,
-                audio=audio_hubert,
+            out_audio, output_sr = convert(
+                vc_pipeline, hubert_model, net_g, audio_hubert, model_sr, version,
                 input_audio_path=args.input,
-                times=[0,0,0],
-                f0_up_key=args.pitch,
+                index=args.index,
+                pitch=args.pitch,
                 f0_method=args.f0_method,
-                file_index=args.index,
                 index_rate=args.index_rate,
-                if_f0=1,
                 filter_radius=args.filter_radius,
-                tgt_sr=model_sr,
-                resample_sr=args.resample_sr if args.resample_sr > 0 else model_sr,
+                resample_sr=args.resample_sr,
                 rms_mix_rate=args.rms_mix_rate,
-                version=version,
                 protect=args.protect,
+                batch_chunks=args.batch_chunks,
+                workers=args.workers,
             )
         print("   - Conversion complete.")
 
         # --- SAVE OUTPUT ---
-        output_sr = args.resample_sr if args.resample_sr > 0 else model_sr
         sf.write(args.output, out_audio, output_sr)
         
         print("\n" + "=" * 40)
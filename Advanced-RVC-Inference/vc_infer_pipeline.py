@@ -3,16 +3,23 @@ from time import time as ttime
 import torch.nn.functional as F
 import scipy.signal as signal
 import pyworld, os, traceback, faiss, librosa, torchcrepe
+import logging, multiprocessing, threading
 from scipy import signal
 from functools import lru_cache
+from feature_index import load_index
 
 now_dir = os.getcwd()
 sys.path.append(now_dir)
 
+logger = logging.getLogger(__name__)
+
 bh, ah = signal.butter(N=5, Wn=48, btype="high", fs=16000)
 
 input_audio_path2wav = {}
 
+# Arguments of the `vc_workers` call that forked this worker process; set by `_init_worker`.
+_worker_state = None
+
 
 @lru_cache
 def cache_harvest_f0(input_audio_path, fs, f0max, f0min, frame_period):
@@ -50,6 +57,40 @@ def change_rms(data1, sr1, data2, sr2, rate):  # 1是输入音频，2是输出
     return data2
 
 
+def _init_worker(state):
+    # Under fork the initializer arguments are inherited, not pickled, so `state` (and the model
+    # weights it references) is shared copy-on-write with the parent.
+    global _worker_state
+    _worker_state = state
+    # GNU OpenMP deadlocks in a forked child that starts a thread team once the parent has used one.
+    torch.set_num_threads(1)
+    faiss.omp_set_num_threads(1)
+
+
+def _convert_chunk(bound):
+    st = _worker_state
+    vc = st["vc"]
+    a0, a1, p0, p1 = bound
+    times = [0, 0, 0]
+    pitch = st["pitch"][:, p0:p1] if st["pitch"] is not None else None
+    pitchf = st["pitchf"][:, p0:p1] if st["pitchf"] is not None else None
+    audio1 = vc.vc(
+        st["model"],
+        st["net_g"],
+        st["sid"],
+        st["audio_pad"][a0:a1],
+        pitch,
+        pitchf,
+        times,
+        st["index"],
+        st["big_npy"],
+        st["index_rate"],
+        st["version"],
+        st["protect"],
+    )
+    return audio1[vc.t_pad_tgt : -vc.t_pad_tgt], times
+
+
 class VC(object):
     def __init__(self, tgt_sr, config):
         self.x_pad, self.x_query, self.x_center, self.x_max, self.is_half = (
@@ -172,6 +213,8 @@ class VC(object):
         elif f0_method == "harvest":
             input_audio_path2wav[input_audio_path] = x.astype(np.double)
             f0 = cache_harvest_f0(input_audio_path, self.sr, f0_max, f0_min, 10)
+            # Only read on a cache miss; dropping it keeps a long-running caller from holding every input.
+            input_audio_path2wav.pop(input_audio_path, None)
             if filter_radius > 2:
                 f0 = signal.medfilt(f0, 3)
         elif f0_method == "crepe":
@@ -227,8 +270,8 @@ class VC(object):
         f0_mel[f0_mel <= 1] = 1
         f0_mel[f0_mel > 255] = 255
         f0_coarse = np.rint(f0_mel).astype(int)
-        print(f"[DEBUG] f0 length={len(f0)} min={np.min(f0):.2f} max={np.max(f0):.2f}")
-        print("[DEBUG] f0 first 20 values:", np.round(f0[:20], 2))
+        logger.debug("f0 length=%d min=%.2f max=%.2f", len(f0), np.min(f0), np.max(f0))
+        logger.debug("f0 first 20 values: %s", np.round(f0[:20], 2))
 
         return f0_coarse, f0bak  # 1-0
 
@@ -274,24 +317,8 @@ class VC(object):
             and isinstance(big_npy, type(None)) == False
             and index_rate != 0
         ):
-            npy = feats[0].cpu().numpy()
-            if self.is_half:
-                npy = npy.astype("float32")
-
-            # _, I = index.search(npy, 1)
-            # npy = big_npy[I.squeeze()]
-
-            score, ix = index.search(npy, k=8)
-            weight = np.square(1 / score)
-            weight /= weight.sum(axis=1, keepdims=True)
-            npy = np.sum(big_npy[ix] * np.expand_dims(weight, axis=2), axis=1)
-
-            if self.is_half:
-                npy = npy.astype("float16")
-            feats = (
-                torch.from_numpy(npy).unsqueeze(0).to(self.device) * index_rate
-                + (1 - index_rate) * feats
-            )
+            # k=8 inverse-square weighted retrieval, on the device when the features fit there.
+            feats = index.blend(feats, index_rate, k=8)
 
         feats = F.interpolate(feats.permute(0, 2, 1), scale_factor=2).permute(0, 2, 1)
         if protect < 0.5 and pitch != None and pitchf != None:
@@ -334,6 +361,212 @@ class VC(object):
         times[2] += t2 - t1
         return audio1
 
+    def hubert_frames(self, model, n):
+        """Number of HuBERT frames for `n` samples, from the strides of its convolutional front end."""
+        for layer in model.feature_extractor.conv_layers:
+            conv = layer[0]
+            n = (n - conv.kernel_size[0]) // conv.stride[0] + 1
+        return n
+
+    def vc_batch(
+        self,
+        model,
+        net_g,
+        sid,
+        audios,
+        pitches,
+        pitchfs,
+        times,
+        index,
+        big_npy,
+        index_rate,
+        version,
+        protect,
+    ):
+        """`vc` for several chunks at once; returns one output array per chunk.
+
+        The chunks are zero-padded to the longest one. HuBERT gets a padding mask and net_g the
+        per-chunk lengths, so padding is masked out of attention and the flow. The first HuBERT
+        conv layer normalizes over the whole padded input, so chunks of very different lengths
+        should go in different batches (see `pipeline`'s `batch_chunks`).
+        """
+        n = len(audios)
+        lengths = [len(a) for a in audios]
+        feats = torch.zeros((n, max(lengths)))
+        padding_mask = torch.ones((n, max(lengths)), dtype=torch.bool)
+        for i, audio0 in enumerate(audios):
+            audio0 = torch.from_numpy(audio0).float()
+            feats[i, : len(audio0)] = audio0.mean(-1) if audio0.dim() == 2 else audio0
+            padding_mask[i, : len(audio0)] = False
+        feats = feats.half() if self.is_half else feats
+
+        inputs = {
+            "source": feats.to(self.device),
+            "padding_mask": padding_mask.to(self.device),
+            "output_layer": 9 if version == "v1" else 12,
+        }
+        t0 = ttime()
+        with torch.no_grad():
+            logits = model.extract_features(**inputs)
+            feats = model.final_proj(logits[0]) if version == "v1" else logits[0]
+        has_pitch = pitches is not None and pitchfs is not None
+        if protect < 0.5 and has_pitch:
+            feats0 = feats.clone()
+        if index is not None and big_npy is not None and index_rate != 0:
+            feats = index.blend(feats.reshape(1, -1, feats.shape[-1]), index_rate, k=8).view(feats.shape)
+
+        feats = F.interpolate(feats.permute(0, 2, 1), scale_factor=2).permute(0, 2, 1)
+        if protect < 0.5 and has_pitch:
+            feats0 = F.interpolate(feats0.permute(0, 2, 1), scale_factor=2).permute(0, 2, 1)
+        t1 = ttime()
+        p_lens = [min(length // self.window, 2 * self.hubert_frames(model, length)) for length in lengths]
+        if has_pitch:
+            p_lens = [min(p_len, pitches[i].shape[1]) for i, p_len in enumerate(p_lens)]
+        p_max = max(p_lens)
+        feats = feats[:, :p_max]
+        if has_pitch:
+            pitch = torch.zeros((n, p_max), dtype=torch.long, device=self.device)
+            pitchf = torch.zeros((n, p_max), dtype=pitchfs[0].dtype, device=self.device)
+            for i, p_len in enumerate(p_lens):
+                pitch[i, :p_len] = pitches[i][0, :p_len]
+                pitchf[i, :p_len] = pitchfs[i][0, :p_len]
+
+        if protect < 0.5 and has_pitch:
+            feats0 = feats0[:, :p_max]
+            pitchff = pitchf.clone()
+            pitchff[pitchf > 0] = 1
+            pitchff[pitchf < 1] = protect
+            pitchff = pitchff.unsqueeze(-1)
+            feats = feats * pitchff + feats0 * (1 - pitchff)
+            feats = feats.to(feats0.dtype)
+        p_len = torch.tensor(p_lens, device=self.device).long()
+        sid = sid.expand(n)
+        with torch.no_grad():
+            if has_pitch:
+                audio1 = net_g.infer(feats, p_len, pitch, pitchf, sid)[0][:, 0]
+            else:
+                audio1 = net_g.infer(feats, p_len, sid)[0][:, 0]
+            audio1 = audio1.data.cpu().float().numpy()
+        upp = audio1.shape[1] // p_max  # output samples per frame
+        t2 = ttime()
+        times[0] += t1 - t0
+        times[2] += t2 - t1
+        return [audio1[i, : p_lens[i] * upp] for i in range(n)]
+
+    def chunk_bounds(self, audio_pad, opt_ts):
+        """(start, end) in `audio_pad` and (start, end) pitch frames of each chunk `pipeline` converts.
+
+        Consecutive chunks overlap by t_pad2 (plus one window), which `vc`'s output loses again
+        when trimmed by t_pad_tgt on both sides.
+        """
+        bounds = []
+        s, t = 0, None
+        for t in opt_ts:
+            t = t // self.window * self.window
+            bounds.append((s, t + self.t_pad2 + self.window, s // self.window, (t + self.t_pad2) // self.window))
+            s = t
+        start = t if t is not None else 0
+        bounds.append((start, len(audio_pad), start // self.window, None))
+        return bounds
+
+    def vc_workers(
+        self,
+        model,
+        net_g,
+        sid,
+        audio_pad,
+        opt_ts,
+        pitch,
+        pitchf,
+        times,
+        index,
+        big_npy,
+        index_rate,
+        version,
+        protect,
+        workers,
+    ):
+        """Converts the chunks between the split points `opt_ts` with `vc` in `workers` forked processes.
+
+        The workers are forked after f0 extraction, so HuBERT, net_g, the index and the padded
+        audio and pitch are shared with this process rather than copied or pickled; only chunk
+        bounds go out and trimmed audio comes back, in the original order. Each worker runs
+        torch and FAISS on a single thread, and there are at most as many workers as CPUs.
+        """
+        bounds = self.chunk_bounds(audio_pad, opt_ts)
+        workers = min(workers, len(bounds), os.cpu_count() or 1)
+        state = dict(
+            vc=self,
+            model=model,
+            net_g=net_g,
+            sid=sid,
+            audio_pad=audio_pad,
+            pitch=pitch,
+            pitchf=pitchf,
+            index=index,
+            big_npy=big_npy,
+            index_rate=index_rate,
+            version=version,
+            protect=protect,
+        )
+        with multiprocessing.get_context("fork").Pool(
+            workers, initializer=_init_worker, initargs=(state,)
+        ) as pool:
+            results = pool.map(_convert_chunk, bounds, chunksize=1)
+        for _, chunk_times in results:
+            times[0] += chunk_times[0]
+            times[2] += chunk_times[2]
+        return [audio1 for audio1, _ in results]
+
+    def vc_chunks(
+        self,
+        model,
+        net_g,
+        sid,
+        audio_pad,
+        opt_ts,
+        pitch,
+        pitchf,
+        times,
+        index,
+        big_npy,
+        index_rate,
+        version,
+        protect,
+        batch_chunks,
+    ):
+        """Converts the chunks between the split points `opt_ts` in batches of up to `batch_chunks`.
+
+        Chunks are the same slices `pipeline` hands to `vc` one by one. They are sorted by length
+        and grouped so the longest chunk of a batch is at most 10% longer than the shortest,
+        which keeps padding small; the trimmed outputs come back in the original order.
+        """
+        bounds = self.chunk_bounds(audio_pad, opt_ts)
+        order = sorted(range(len(bounds)), key=lambda i: bounds[i][1] - bounds[i][0])
+        batches, batch = [], []
+        for i in order:
+            length = bounds[i][1] - bounds[i][0]
+            if batch and (len(batch) >= batch_chunks or length > 1.1 * (bounds[batch[0]][1] - bounds[batch[0]][0])):
+                batches.append(batch)
+                batch = []
+            batch.append(i)
+        batches.append(batch)
+
+        audio_opt = [None] * len(bounds)
+        for batch in batches:
+            audios = [audio_pad[bounds[i][0] : bounds[i][1]] for i in batch]
+            if pitch is not None:
+                pitches = [pitch[:, bounds[i][2] : bounds[i][3]] for i in batch]
+                pitchfs = [pitchf[:, bounds[i][2] : bounds[i][3]] for i in batch]
+            else:
+                pitches = pitchfs = None
+            outputs = self.vc_batch(
+                model, net_g, sid, audios, pitches, pitchfs, times, index, big_npy, index_rate, version, protect
+            )
+            for i, out in zip(batch, outputs):
+                audio_opt[i] = out[self.t_pad_tgt : -self.t_pad_tgt]
+        return audio_opt
+
     def pipeline(
         self,
         model,
@@ -355,7 +588,16 @@ class VC(object):
         version,
         protect,
         f0_file=None,
+        batch_chunks=1,
+        workers=0,
     ):
+        """Converts `audio`. Long inputs are split into chunks that are converted one by one, or
+        on the CPU with `workers` > 1 in that many forked processes (see `vc_workers`), or with
+        `batch_chunks` > 1 in batches through HuBERT and net_g (see `vc_chunks`).
+
+        Forking a process that runs other threads is unsafe (a lock held by one of them stays
+        locked in the child), so `workers` is ignored unless this is the only Python thread;
+        from the dubbing server or DubbingPipeline.run_batch the chunks are converted in-process."""
         if (
             file_index != ""
             # and file_big_npy != ""
@@ -364,9 +606,9 @@ class VC(object):
             and index_rate != 0
         ):
             try:
-                index = faiss.read_index(file_index)
-                # big_npy = np.load(file_big_npy)
-                big_npy = index.reconstruct_n(0, index.ntotal)
+                # Loaded once per file and memory-mapped; the features come from a cached sidecar.
+                index = load_index(file_index)
+                big_npy = index.big_npy
             except:
                 traceback.print_exc()
                 index = big_npy = None
@@ -425,17 +667,93 @@ class VC(object):
             pitchf = torch.tensor(pitchf, device=self.device).unsqueeze(0).float()
         t2 = ttime()
         times[1] += t2 - t1
-        for t in opt_ts:
-            t = t // self.window * self.window
+        if (
+            workers > 1
+            and self.device == "cpu"
+            and opt_ts
+            and "fork" in multiprocessing.get_all_start_methods()
+            and threading.active_count() == 1
+        ):
+            audio_opt = self.vc_workers(
+                model,
+                net_g,
+                sid,
+                audio_pad,
+                opt_ts,
+                pitch,
+                pitchf,
+                times,
+                index,
+                big_npy,
+                index_rate,
+                version,
+                protect,
+                workers,
+            )
+        elif batch_chunks > 1:
+            audio_opt = self.vc_chunks(
+                model,
+                net_g,
+                sid,
+                audio_pad,
+                opt_ts,
+                pitch,
+                pitchf,
+                times,
+                index,
+                big_npy,
+                index_rate,
+                version,
+                protect,
+                batch_chunks,
+            )
+        else:
+            for t in opt_ts:
+                t = t // self.window * self.window
+                if if_f0 == 1:
+                    audio_opt.append(
+                        self.vc(
+                            model,
+                            net_g,
+                            sid,
+                            audio_pad[s : t + self.t_pad2 + self.window],
+                            pitch[:, s // self.window : (t + self.t_pad2) // self.window],
+                            pitchf[:, s // self.window : (t + self.t_pad2) // self.window],
+                            times,
+                            index,
+                            big_npy,
+                            index_rate,
+                            version,
+                            protect,
+                        )[self.t_pad_tgt : -self.t_pad_tgt]
+                    )
+                else:
+                    audio_opt.append(
+                        self.vc(
+                            model,
+                            net_g,
+                            sid,
+                            audio_pad[s : t + self.t_pad2 + self.window],
+                            None,
+                            None,
+                            times,
+                            index,
+                            big_npy,
+                            index_rate,
+                            version,
+                            protect,
+                        )[self.t_pad_tgt : -self.t_pad_tgt]
+                    )
+                s = t
             if if_f0 == 1:
                 audio_opt.append(
                     self.vc(
                         model,
                         net_g,
                         sid,
-                        audio_pad[s : t + self.t_pad2 + self.window],
-                        pitch[:, s // self.window : (t + self.t_pad2) // self.window],
-                        pitchf[:, s // self.window : (t + self.t_pad2) // self.window],
+                        audio_pad[t:],
+                        pitch[:, t // self.window :] if t is not None else pitch,
+                        pitchf[:, t // self.window :] if t is not None else pitchf,
                         times,
                         index,
                         big_npy,
@@ -450,7 +768,7 @@ class VC(object):
                         model,
                         net_g,
                         sid,
-                        audio_pad[s : t + self.t_pad2 + self.window],
+                        audio_pad[t:],
                         None,
                         None,
                         times,
@@ -461,41 +779,6 @@ class VC(object):
                         protect,
                     )[self.t_pad_tgt : -self.t_pad_tgt]
                 )
-            s = t
-        if if_f0 == 1:
-            audio_opt.append(
-                self.vc(
-                    model,
-                    net_g,
-                    sid,
-                    audio_pad[t:],
-                    pitch[:, t // self.window :] if t is not None else pitch,
-                    pitchf[:, t // self.window :] if t is not None else pitchf,
-                    times,
-                    index,
-                    big_npy,
-                    index_rate,
-                    version,
-                    protect,
-                )[self.t_pad_tgt : -self.t_pad_tgt]
-            )
-        else:
-            audio_opt.append(
-                self.vc(
-                    model,
-                    net_g,
-                    sid,
-                    audio_pad[t:],
-                    None,
-                    None,
-                    times,
-                    index,
-                    big_npy,
-                    index_rate,
-                    version,
-                    protect,
-                )[self.t_pad_tgt : -self.t_pad_tgt]
-            )
         audio_opt = np.concatenate(audio_opt)
         if rms_mix_rate != 1:
             audio_opt = change_rms(audio, 16000, audio_opt, tgt_sr, rms_mix_rate)
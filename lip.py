@@ -53,8 +53,9 @@ def run_wav2lip(video_path, audio_path, output_path, checkpoint_path, box_coords
         "--face", video_path,
         "--audio", audio_path,
         "--outfile", output_path,
-        "--wav2lip_batch_size", "8",
-        "--pads", "0", "10", "0", "0"
+        "--auto_batch",
+        "--pads", "0", "10", "0", "0",
+        "--stream"
     ]
 
     if box_coords:
@@ -1,6 +1,7 @@
 import os
 import subprocess
 import argparse
+import shlex
 import shutil
 from pathlib import Path
 
@@ -12,7 +13,8 @@ def run_command(cmd, cwd=None):
         print(f"❌ Command failed with return code {process.returncode}: {cmd}")
         raise RuntimeError(f"Command failed: {cmd}")
 
-def main(video_file, final_output_filename):
+def run_subprocesses(video_file, final_output_filename):
+    """Original pipeline: each stage is a separate python process talking through wav files."""
     demo_dir = Path(__file__).parent.resolve()
     rvc_dir = demo_dir / "Advanced-RVC-Inference"
 
@@ -72,10 +74,81 @@ def main(video_file, final_output_filename):
     print(f"🎉 Final lip-synced dubbed video ready: {final_output_path}")
     print("========================================")
 
+def make_cache(no_cache, cache_size_gb):
+    if no_cache:
+        return None
+    from stage_cache import StageCache
+    return StageCache(max_bytes=int(cache_size_gb * 1024 ** 3))
+
+def main(video_file, final_output_filename, cache=None):
+    """Runs every stage in this process via pipeline.DubbingPipeline (models loaded once)."""
+    from pipeline import DubbingPipeline
+
+    demo_dir = Path(__file__).parent.resolve()
+    final_output_path = demo_dir / final_output_filename
+
+    job = DubbingPipeline(cache=cache).run(Path(video_file).resolve(), final_output_path)
+
+    print("\n========================================")
+    print(f"🎉 Final lip-synced dubbed video ready: {final_output_path}")
+    print("   " + ", ".join(f"{name}: {seconds:.1f}s" for name, seconds in job.timings.items()))
+    print("========================================")
+
+def read_batch_list(batch_file):
+    """Each non-empty, non-# line is `input_video [output_video]`; quote paths containing spaces."""
+    demo_dir = Path(__file__).parent.resolve()
+    entries = []
+    with open(batch_file, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            parts = shlex.split(line)
+            video_file = Path(parts[0]).resolve()
+            output_file = demo_dir / (parts[1] if len(parts) > 1 else f"{video_file.stem}_dubbed.mp4")
+            entries.append((video_file, output_file))
+    return entries
+
+def run_batch(batch_file, queue_size, cache=None):
+    """Dubs every video in `batch_file`, overlapping the stages of consecutive videos."""
+    from pipeline import DubbingJob, DubbingPipeline
+
+    entries = read_batch_list(batch_file)
+    print(f"🚀 Dubbing {len(entries)} video(s) from {batch_file}...")
+    jobs = (DubbingJob(video_file, output_file) for video_file, output_file in entries)
+
+    failed = 0
+    for job in DubbingPipeline(cache=cache).run_batch(jobs, queue_size=queue_size):
+        if job.error:
+            failed += 1
+            print(f"❌ {job.video_file}: {job.error}")
+        else:
+            print(f"🎉 {job.video_file} -> {job.output_file}")
+
+    print("\n========================================")
+    print(f"Batch finished: {len(entries) - failed} succeeded, {failed} failed.")
+    print("========================================")
+    if failed:
+        raise SystemExit(1)
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
-    parser.add_argument("--video_file", required=True, help="Input video file (e.g., test.mp4)")
-    parser.add_argument("--output_file", required=True, help="Final output video file (e.g., final_video.mp4)")
+    parser.add_argument("--video_file", help="Input video file (e.g., test.mp4)")
+    parser.add_argument("--output_file", help="Final output video file (e.g., final_video.mp4)")
+    parser.add_argument("--batch", help="Text file listing one 'input_video [output_video]' per line; stages of consecutive videos overlap")
+    parser.add_argument("--queue_size", type=int, default=1, help="Videos buffered between two stages in --batch mode")
+    parser.add_argument("--subprocess", action="store_true", help="Run each stage as a separate python process (old behaviour)")
+    parser.add_argument("--no-cache", dest="no_cache", action="store_true", help="Recompute every stage instead of reusing cached artifacts from .cache/stages")
+    parser.add_argument("--cache_size_gb", type=float, default=5, help="Least recently used stage artifacts are evicted beyond this size")
     args = parser.parse_args()
 
-    main(args.video_file, args.output_file)
\ No newline at end of file
+    if args.batch:
+        if args.video_file or args.subprocess:
+            parser.error("--batch cannot be combined with --video_file or --subprocess")
+        run_batch(args.batch, args.queue_size, make_cache(args.no_cache, args.cache_size_gb))
+    elif not (args.video_file and args.output_file):
+        parser.error("--video_file and --output_file are required unless --batch is given")
+    elif args.subprocess:
+        run_subprocesses(args.video_file, args.output_file)
+    else:
+        main(args.video_file, args.output_file, make_cache(args.no_cache, args.cache_size_gb))
\ No newline at end of file
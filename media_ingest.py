@@ -0,0 +1,164 @@
+"""
+Single-pass media ingest for the dubbing pipeline.
+
+The input video used to be decoded four times per job (moviepy audio
+extraction in 1.py, moviepy resize + x264 re-encode in lip.py, a second
+moviepy audio extraction in lip.py, cv2.VideoCapture in wav2Lip). ingest()
+runs one ffmpeg process that decodes the file once and produces, from that
+single decode:
+
+  * BGR uint8 frames scaled to the lip-sync resolution and frame rate,
+  * mono float32 audio at every requested sample rate.
+
+With video=False only the audio is decoded. The frames are then read later,
+one at a time, through Media.frame_reader(), so a long video is never held in
+memory as a whole.
+"""
+import json
+import os
+import subprocess
+import tempfile
+
+import numpy as np
+
+
+class Media:
+    """Decoded audio of one input video, and its frames unless it was ingested with video=False."""
+
+    def __init__(self, path, frames, fps, audio, source_size, frame_size, n_frames):
+        self.path = path
+        self.frames = frames          # list of (H, W, 3) uint8 BGR arrays; empty with video=False
+        self.fps = fps
+        self.audio = audio            # {sample_rate: mono float32 array}
+        self.source_size = source_size  # (width, height) before scaling
+        self.frame_size = frame_size  # (width, height) of the frames
+        self.n_frames = n_frames      # len(frames), or the count expected from the duration
+
+    def frame_reader(self):
+        """A VideoFrames that yields the same frames as ingest(video=True), one at a time."""
+        return VideoFrames(self.path, self.frame_size, self.fps, self.source_size)
+
+
+class VideoFrames:
+    """Re-iterable ffmpeg decode of the video stream only, at a given size and frame rate.
+
+    Each iteration starts its own ffmpeg process and holds one frame at a time, so callers can
+    stream (and cycle) the video. Has the `fps` that wav2Lip's stream_lip_sync expects.
+    """
+
+    def __init__(self, path, size, fps, source_size=None):
+        self.path = path
+        self.size = size
+        self.fps = fps
+        self.source_size = source_size
+
+    def __iter__(self):
+        command = ["ffmpeg", "-v", "error", "-nostdin", "-i", self.path]
+        command += _video_output(self.source_size, self.size, self.fps)
+        process = subprocess.Popen(command, stdout=subprocess.PIPE)
+        try:
+            yield from _read_frames(process.stdout, self.size)
+            if process.wait() != 0:
+                raise RuntimeError(f"ffmpeg failed to decode {self.path} (return code {process.returncode})")
+        finally:
+            # Also reached when the consumer stops early.
+            if process.poll() is None:
+                process.kill()
+            process.stdout.close()
+            process.wait()
+
+
+def probe(path):
+    """Returns (width, height, has_audio, duration) of the first video stream, with rotation metadata applied."""
+    command = ["ffprobe", "-v", "error", "-show_streams", "-show_format", "-of", "json", path]
+    info = json.loads(subprocess.check_output(command))
+    streams = info["streams"]
+    video = next(s for s in streams if s.get("codec_type") == "video")
+    has_audio = any(s.get("codec_type") == "audio" for s in streams)
+
+    width, height = int(video["width"]), int(video["height"])
+    rotation = int(video.get("tags", {}).get("rotate", 0))
+    for side_data in video.get("side_data_list", []):
+        rotation = int(side_data.get("rotation", rotation))
+    if abs(rotation) % 180 == 90:  # ffmpeg auto-rotates, so the decoded frames are transposed
+        width, height = height, width
+    duration = float(video.get("duration") or info.get("format", {}).get("duration") or 0)
+    return width, height, has_audio, duration
+
+
+def scaled_size(width, height, target_height):
+    """Output size for a target height, keeping aspect ratio with an even width (same rule as ffmpeg's -2)."""
+    if not target_height:
+        return width, height
+    return max(2, int(round(width * target_height / height / 2.0)) * 2), int(target_height)
+
+
+def ingest(path, target_height=480, fps=25, sample_rates=(16000,), video=True):
+    """Decodes `path` once into a Media.
+
+    Frames are scaled to `target_height` (None keeps the source size) and
+    resampled to `fps` (None keeps the source rate). Audio is downmixed to
+    mono and written at each rate in `sample_rates`. With `video` False the
+    frames are not decoded; Media.n_frames is then estimated from the
+    duration and Media.frame_reader() streams them on demand.
+    """
+    if not os.path.isfile(path):
+        raise FileNotFoundError(f"Input video not found: {path}")
+    src_w, src_h, has_audio, duration = probe(path)
+    out_w, out_h = scaled_size(src_w, src_h, target_height)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        command = ["ffmpeg", "-v", "error", "-nostdin", "-i", path]
+        audio_files = {}
+        if has_audio:
+            for sr in sample_rates:
+                audio_files[sr] = os.path.join(tmp_dir, f"audio_{sr}.f32")
+                command += ["-map", "0:a:0", "-ac", "1", "-ar", str(sr), "-f", "f32le", "-y", audio_files[sr]]
+        if video:
+            command += _video_output((src_w, src_h), (out_w, out_h), fps)
+
+        frames = []
+        if video or audio_files:
+            process = subprocess.Popen(command, stdout=subprocess.PIPE if video else subprocess.DEVNULL)
+            if video:
+                frames = list(_read_frames(process.stdout, (out_w, out_h)))
+                process.stdout.close()
+            if process.wait() != 0:
+                raise RuntimeError(f"ffmpeg failed to decode {path} (return code {process.returncode})")
+
+        audio = {sr: np.fromfile(f, dtype=np.float32) for sr, f in audio_files.items()}
+
+    if not fps:
+        fps = _source_fps(path)
+    n_frames = len(frames) if video else int(round(duration * fps))
+    return Media(path, frames, fps, audio, (src_w, src_h), (out_w, out_h), n_frames)
+
+
+def _video_output(source_size, size, fps):
+    """ffmpeg output options that write the first video stream as raw BGR frames of `size` at `fps` to stdout."""
+    filters = []
+    if fps:
+        filters.append(f"fps={fps}")
+    if source_size is not None and tuple(size) != tuple(source_size):
+        filters.append(f"scale={size[0]}:{size[1]}")
+    command = ["-map", "0:v:0"]
+    if filters:
+        command += ["-vf", ",".join(filters)]
+    return command + ["-pix_fmt", "bgr24", "-f", "rawvideo", "pipe:1"]
+
+
+def _read_frames(stream, size):
+    width, height = size
+    frame_bytes = width * height * 3
+    while True:
+        buf = bytearray(frame_bytes)  # writable, so frames can be patched in place downstream
+        if stream.readinto(buf) < frame_bytes:
+            return
+        yield np.frombuffer(buf, dtype=np.uint8).reshape(height, width, 3)
+
+
+def _source_fps(path):
+    command = ["ffprobe", "-v", "error", "-select_streams", "v:0", "-show_entries", "stream=avg_frame_rate",
+               "-of", "default=noprint_wrappers=1:nokey=1", path]
+    num, _, den = subprocess.check_output(command).decode().strip().partition("/")
+    return float(num) / float(den or 1)
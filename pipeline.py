@@ -0,0 +1,408 @@
+"""
+In-process version of the main.py pipeline.
+
+main.py launches 1.py, my_convert.py, ffmpeg and lip.py as separate python
+processes, so every dub pays the torch/transformers/fairseq imports and every
+model load again. DubbingPipeline imports those scripts as libraries instead,
+keeps Whisper, NLLB, MMS-TTS, HuBERT, the RVC generator and Wav2Lip loaded
+between jobs and hands audio from stage to stage as numpy arrays.
+
+    pipeline = DubbingPipeline()
+    pipeline.run("test.mp4", "output.mp4")
+"""
+import hashlib
+import importlib
+import os
+import queue
+import sys
+import tempfile
+import threading
+import time
+import traceback
+from pathlib import Path
+
+import librosa
+import numpy as np
+import scipy.io.wavfile
+
+import media_ingest
+
+ROOT_DIR = Path(__file__).parent.resolve()
+RVC_DIR = ROOT_DIR / "Advanced-RVC-Inference"
+WAV2LIP_DIR = ROOT_DIR / "wav2Lip"
+
+# 1.py, my_convert.py and wav2Lip/inference.py import their siblings by bare name.
+for _path in (ROOT_DIR, RVC_DIR, WAV2LIP_DIR):
+    if str(_path) not in sys.path:
+        sys.path.insert(0, str(_path))
+
+
+class DubbingJob:
+    """One video moving through the pipeline, plus the in-memory output of each stage."""
+
+    def __init__(self, video_file, output_file, pitch=0, f0_method="rmvpe", index_rate=0.7,
+                 filter_radius=3, resample_sr=0, rms_mix_rate=1.0, protect=0.33,
+                 batch_chunks=1, rvc_workers=0,
+                 pads=(0, 10, 0, 0), wav2lip_batch_size=128, target_height=480, box=None,
+                 encoder="libx264", preset="medium", encoder_threads=0, feather=0,
+                 detect_every=1, detect_size=0, auto_batch=True, memory_budget_gb=0,
+                 smoothing="mean", faces="best", max_gap=5, precision="fp32", channels_last=False):
+        self.video_file = str(video_file)
+        self.output_file = str(output_file)
+
+        # my_convert.py options
+        self.pitch = pitch
+        self.f0_method = f0_method
+        self.index_rate = index_rate
+        self.filter_radius = filter_radius
+        self.resample_sr = resample_sr
+        self.rms_mix_rate = rms_mix_rate
+        self.protect = protect
+        self.batch_chunks = batch_chunks
+        self.rvc_workers = rvc_workers  # CPU chunk conversion processes; not used by run_batch or the server
+
+        # lip.py / wav2Lip options
+        self.pads = list(pads)
+        self.wav2lip_batch_size = wav2lip_batch_size  # upper bound when auto_batch is set
+        self.target_height = target_height
+        self.box = box
+        self.encoder = encoder
+        self.preset = preset
+        self.encoder_threads = encoder_threads
+        self.feather = feather
+        self.detect_every = detect_every
+        self.detect_size = detect_size
+        self.auto_batch = auto_batch
+        self.memory_budget_gb = memory_budget_gb
+        self.smoothing = smoothing
+        self.faces = faces
+        self.max_gap = max_gap
+        self.precision = precision  # fp32, fp16 or bf16 for S3FD and Wav2Lip
+        self.channels_last = channels_last
+
+        # Stage outputs
+        self.media = None
+        self.audio_16k = None
+        self.english_text = None
+        self.translated_text = None
+        self.tts_audio = None
+        self.tts_sr = None
+        self.converted_audio = None
+        self.converted_sr = None
+
+        self.cache_keys = {}
+        self.timings = {}
+        self.error = None
+
+    def release(self):
+        """Drops the stage outputs once the job is finished, keeping only its timings."""
+        self.media = self.audio_16k = self.tts_audio = self.converted_audio = None
+
+
+class DubbingPipeline:
+    """Runs transcription -> translation -> TTS -> RVC -> Wav2Lip in this process with resident models."""
+
+    STAGES = ("ingest", "transcribe", "translate", "synthesize", "convert_voice", "lip_sync")
+
+    def __init__(self, voice_model=RVC_DIR / "weights" / "modi.pth",
+                 voice_index=RVC_DIR / "weights" / "model.index",
+                 wav2lip_checkpoint=WAV2LIP_DIR / "checkpoints" / "wav2lip.pth", cache=None):
+        self.voice_model = str(voice_model)
+        self.voice_index = str(voice_index) if os.path.exists(voice_index) else ""
+        self.wav2lip_checkpoint = str(wav2lip_checkpoint)
+        self.cache = cache  # a stage_cache.StageCache, or None to always recompute
+        self.loaded = False
+
+    # ------------------------------------------------------------------ loading
+
+    def load(self):
+        """Imports every stage and loads all models once. Safe to call repeatedly."""
+        if self.loaded:
+            return
+        start_time = time.time()
+        print("📦 Loading dubbing models...")
+
+        self.translation = importlib.import_module("1")
+        self.cfg = self.translation.Config()
+        self.cfg.WHISPER_MODEL_PATH = ROOT_DIR / "models" / "whisper"
+        self.cfg.TRANSLATION_MODEL_PATH = ROOT_DIR / "models" / "translation" / "nllb-en-te"
+        self.cfg.TTS_MODEL_PATH = ROOT_DIR / "models" / "tts" / "mms-tel"
+        self.whisper_model = self.translation.load_whisper_model(self.cfg)
+        self.nllb = self.translation.load_translation_model(self.cfg)
+        self.mms_tts = self.translation.load_tts_model(self.cfg)
+
+        self.rvc = importlib.import_module("my_convert")
+        with self.rvc.suppress_stdout_stderr():
+            self.rvc_config = self.rvc.Config()
+            self.vc = self.rvc.VC(tgt_sr=16000, config=self.rvc_config)
+            self.hubert = self.rvc.load_hubert(str(RVC_DIR / "hubert_base.pt"), self.rvc_config)
+            # VC.get_f0 loads rmvpe.pt from the cwd on first use; preload it by absolute path.
+            from rmvpe import RMVPE
+            self.vc.model_rmvpe = RMVPE(str(RVC_DIR / "rmvpe.pt"), is_half=self.rvc_config.is_half,
+                                        device=self.rvc_config.device)
+        self.net_g, self.model_sr, self.version = self.rvc.load_voice_model(self.vc, self.voice_model)
+        if self.voice_index:
+            # Memory-mapped once here; VC.pipeline gets the same index on every job.
+            self.rvc.load_index(self.voice_index).big_npy
+
+        self.wav2lip = importlib.import_module("inference")
+        self.wav2lip_model = self.wav2lip.load_model(self.wav2lip_checkpoint)
+        self.detector = self.wav2lip.load_detector()
+
+        if self.cache is not None:
+            self.model_hashes = {
+                name: self.cache.file_hash(path) if os.path.exists(path) else str(path)
+                for name, path in (
+                    ("whisper", self.cfg.WHISPER_MODEL_PATH / f"{self.cfg.WHISPER_MODEL_NAME}.pt"),
+                    ("nllb", self.cfg.TRANSLATION_MODEL_PATH),
+                    ("mms_tts", self.cfg.TTS_MODEL_PATH),
+                    ("hubert", RVC_DIR / "hubert_base.pt"),
+                    ("rmvpe", RVC_DIR / "rmvpe.pt"),
+                    ("rvc_generator", self.voice_model),
+                    ("rvc_index", self.voice_index),
+                    ("s3fd", WAV2LIP_DIR / "face_detection" / "detection" / "sfd" / "s3fd.pth"),
+                )
+            }
+
+        self.loaded = True
+        print(f"✅ Models loaded in {time.time() - start_time:.2f}s.")
+
+    def model_memory(self):
+        """Bytes held by each resident model's parameters and buffers."""
+        if not self.loaded:
+            return {}
+        modules = {
+            "whisper": self.whisper_model,
+            "nllb": self.nllb[1],
+            "mms_tts": self.mms_tts[1],
+            "hubert": self.hubert,
+            "rmvpe": self.vc.model_rmvpe.model,
+            "rvc_generator": self.net_g,
+            "wav2lip": self.wav2lip_model,
+            "s3fd": self.detector.face_detector.face_detector,
+        }
+        return {
+            name: sum(t.numel() * t.element_size() for t in list(m.parameters()) + list(m.buffers()))
+            for name, m in modules.items()
+        }
+
+    # ------------------------------------------------------------------ cache
+
+    def plan_cache_keys(self, job):
+        """Derives every stage's cache key up front; each key chains the key of the stage it consumes."""
+        cache, h, keys = self.cache, self.model_hashes, job.cache_keys
+        keys["input"] = cache.file_hash(job.video_file)
+        keys["transcribe"] = cache.key("transcribe", keys["input"], self.cfg.WHISPER_MODEL_NAME, h["whisper"])
+        keys["translate"] = cache.key("translate", keys["transcribe"], self.cfg.SRC_LANG, self.cfg.TGT_LANG, h["nllb"])
+        keys["synthesize"] = cache.key("synthesize", keys["translate"], h["mms_tts"])
+        keys["convert_voice"] = cache.key(
+            "convert_voice", keys["synthesize"], h["hubert"], h["rmvpe"], h["rvc_generator"], h["rvc_index"],
+            job.pitch, job.f0_method, job.index_rate, job.filter_radius, job.resample_sr, job.rms_mix_rate, job.protect,
+            job.batch_chunks)
+        keys["face_boxes"] = cache.key("face_boxes", keys["input"], job.target_height, job.pads, job.box,
+                                       job.detect_every, job.detect_size, job.smoothing, job.faces,
+                                       job.max_gap, job.precision, job.channels_last, h["s3fd"])
+        keys["mel_chunks"] = cache.key("mel_windows", keys["convert_voice"], keys["input"], job.target_height)
+
+    def _cache_get(self, job, artifact):
+        if self.cache is None:
+            return None
+        cached = self.cache.get(job.cache_keys[artifact])
+        if cached is not None:
+            print(f"♻️  Reusing cached {artifact} for {os.path.basename(job.video_file)}")
+        return cached
+
+    def _cache_put(self, job, artifact, **arrays):
+        if self.cache is not None:
+            self.cache.put(job.cache_keys[artifact], **arrays)
+
+    # ------------------------------------------------------------------ stages
+
+    def ingest(self, job):
+        """Decodes the 16 kHz audio for Whisper and probes the video.
+
+        The frames are not decoded here: lip_sync streams them at the lip-sync resolution, so a job
+        waiting in run_batch or the server holds no video in memory.
+        """
+        if self.cache is not None:
+            self.plan_cache_keys(job)
+        job.media = media_ingest.ingest(job.video_file, target_height=job.target_height, fps=25,
+                                        sample_rates=(16000,), video=False)
+        job.audio_16k = job.media.audio.get(16000)
+        if not job.media.n_frames:
+            raise RuntimeError(f"No video frames in {job.video_file}")
+
+    def transcribe(self, job):
+        cached = self._cache_get(job, "transcribe")
+        if cached is not None:
+            job.english_text = str(cached["text"])
+            return
+        job.english_text = self.translation.transcribe_audio(job.audio_16k, self.cfg, model=self.whisper_model)
+        if not job.english_text:
+            raise RuntimeError(f"Transcription failed: {job.video_file}")
+        self._cache_put(job, "transcribe", text=job.english_text)
+
+    def translate(self, job):
+        cached = self._cache_get(job, "translate")
+        if cached is not None:
+            job.translated_text = str(cached["text"])
+            return
+        job.translated_text = self.translation.translate_text(job.english_text, self.cfg, models=self.nllb)
+        if not job.translated_text:
+            raise RuntimeError(f"Translation failed: {job.video_file}")
+        self._cache_put(job, "translate", text=job.translated_text)
+
+    def synthesize(self, job):
+        cached = self._cache_get(job, "synthesize")
+        if cached is not None:
+            job.tts_audio, job.tts_sr = cached["audio"], int(cached["sr"])
+            return
+        synthesized = self.translation.synthesize_waveform(job.translated_text, self.cfg, models=self.mms_tts)
+        if synthesized is None:
+            raise RuntimeError(f"Speech synthesis failed: {job.video_file}")
+        job.tts_audio, job.tts_sr = synthesized
+        self._cache_put(job, "synthesize", audio=job.tts_audio, sr=job.tts_sr)
+
+    def convert_voice(self, job):
+        cached = self._cache_get(job, "convert_voice")
+        if cached is not None:
+            job.converted_audio, job.converted_sr = cached["audio"], int(cached["sr"])
+            return
+        audio = job.tts_audio.astype(np.float32)
+        if job.tts_sr != 16000:
+            audio = librosa.resample(audio, orig_sr=job.tts_sr, target_sr=16000)
+        # Harvest f0 is cached by `input_audio_path`, so the key must change with the waveform.
+        audio_key = f"{job.video_file}#{hashlib.sha1(audio.tobytes()).hexdigest()}"
+        # No stdout redirect here: it is process-wide, and this stage runs alongside others in the
+        # server and run_batch. RVC's per-call diagnostics go to the `vc_infer_pipeline` logger.
+        job.converted_audio, job.converted_sr = self.rvc.convert(
+            self.vc, self.hubert, self.net_g, audio, self.model_sr, self.version,
+            input_audio_path=audio_key,
+            index=self.voice_index,
+            pitch=job.pitch,
+            f0_method=job.f0_method,
+            index_rate=job.index_rate,
+            filter_radius=job.filter_radius,
+            resample_sr=job.resample_sr,
+            rms_mix_rate=job.rms_mix_rate,
+            protect=job.protect,
+            batch_chunks=job.batch_chunks,
+            workers=job.rvc_workers,
+        )
+        self._cache_put(job, "convert_voice", audio=job.converted_audio, sr=job.converted_sr)
+
+    def lip_sync(self, job):
+        argv = ["--checkpoint_path", self.wav2lip_checkpoint, "--face", job.video_file,
+                "--audio", job.video_file, "--outfile", job.output_file,
+                "--wav2lip_batch_size", str(job.wav2lip_batch_size),
+                "--pads", *[str(p) for p in job.pads],
+                "--encoder", job.encoder, "--preset", job.preset, "--encoder_threads", str(job.encoder_threads),
+                "--feather", str(job.feather), "--detect_every", str(job.detect_every),
+                "--detect_size", str(job.detect_size), "--memory_budget", str(job.memory_budget_gb),
+                "--smooth", job.smoothing, "--fps", str(job.media.fps), "--faces", str(job.faces),
+                "--max_gap", str(job.max_gap), "--precision", job.precision,
+                # Boxes are cached per job in the stage cache; the streamed frames are rescaled.
+                "--no_box_index"]
+        if job.box:
+            argv.extend(["--box", *[str(c) for c in job.box]])
+        if job.auto_batch:
+            argv.append("--auto_batch")
+        if job.channels_last:
+            argv.append("--channels_last")
+        self.wav2lip.parse_args(argv)
+
+        reader, fps = job.media.frame_reader(), job.media.fps
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            wav = job.converted_audio.astype(np.float32) / 32768.0
+            if job.converted_sr != 16000:
+                wav = librosa.resample(wav, orig_sr=job.converted_sr, target_sr=16000)
+            # main.py muxed with -shortest before lip.py re-extracted the audio.
+            wav = wav[:int(job.media.n_frames / fps * 16000)]
+
+            audio_path = os.path.join(tmp_dir, "dubbed_audio.wav")
+            scipy.io.wavfile.write(audio_path, 16000, (wav * 32767).astype(np.int16))
+
+            cached = self._cache_get(job, "mel_chunks")
+            if cached is not None:
+                mel_chunks = self.wav2lip.MelChunks(cached["mel"], cached["starts"])
+            else:
+                mel_chunks = self.wav2lip.get_mel_chunks(wav, fps)
+                # The spectrogram and the window starts, not the overlapping per-frame windows.
+                self._cache_put(job, "mel_chunks", mel=mel_chunks.mel, starts=mel_chunks.starts)
+
+            # Cached boxes cover the frames of the dub they were detected for; a longer dub of the
+            # same video needs boxes for frames that were never reached.
+            cached = self._cache_get(job, "face_boxes")
+            face_boxes = cached["boxes"] if cached is not None and len(cached["boxes"]) >= len(mel_chunks) else None
+
+            # Without cached boxes the faces are detected while rendering, in the same decode.
+            boxes = self.wav2lip.stream_lip_sync(reader, wav, audio_path, job.output_file,
+                                                 model=self.wav2lip_model, detector=self.detector,
+                                                 face_boxes=face_boxes, mel_chunks=mel_chunks)
+            if face_boxes is None:
+                self._cache_put(job, "face_boxes", boxes=boxes)
+
+    # ------------------------------------------------------------------ driver
+
+    def run_stage(self, name, job):
+        start_time = time.time()
+        getattr(self, name)(job)
+        job.timings[name] = time.time() - start_time
+
+    def run_job(self, job):
+        self.load()
+        for name in self.STAGES:
+            self.run_stage(name, job)
+        return job
+
+    def run_batch(self, jobs, queue_size=1):
+        """Dubs many jobs with the stages overlapped across videos.
+
+        Each stage runs on its own thread and hands jobs on through a bounded
+        queue, so video N+1 is transcribed while video N is in RVC and video
+        N-1 is being lip-synced. Models are not duplicated: every stage still
+        has exactly one user. A job that fails is marked with `error` and
+        skips the remaining stages; the others carry on. Jobs are yielded as
+        they finish.
+        """
+        self.load()
+        done = object()
+        queues = [queue.Queue(maxsize=queue_size) for _ in range(len(self.STAGES) + 1)]
+
+        def feed():
+            for job in jobs:
+                queues[0].put(job)
+            queues[0].put(done)
+
+        def stage_worker(name, inbox, outbox):
+            while True:
+                job = inbox.get()
+                if job is not done and job.error is None:
+                    try:
+                        self.run_stage(name, job)
+                    except Exception as e:
+                        traceback.print_exc()
+                        job.error = f"{name}: {type(e).__name__}: {e}"
+                outbox.put(job)
+                if job is done:
+                    return
+
+        threads = [threading.Thread(target=feed, name="batch-feed", daemon=True)]
+        for i, name in enumerate(self.STAGES):
+            threads.append(threading.Thread(target=stage_worker, args=(name, queues[i], queues[i + 1]),
+                                            name=f"batch-{name}", daemon=True))
+        for t in threads:
+            t.start()
+
+        while True:
+            job = queues[-1].get()
+            if job is done:
+                break
+            job.release()
+            yield job
+        for t in threads:
+            t.join()
+
+    def run(self, video_file, output_file, **options):
+        """Dubs `video_file` into `output_file`; `options` are DubbingJob keyword arguments."""
+        return self.run_job(DubbingJob(video_file, output_file, **options))
@@ -0,0 +1,362 @@
+"""
+Long-running dubbing daemon.
+
+Loads every model once through pipeline.DubbingPipeline, accepts dubbing jobs
+over a small JSON HTTP API (TCP or Unix socket) into a bounded queue and runs
+them on a pool of workers, with a concurrency limit per pipeline stage.
+
+    python server.py --port 8765 --workers 2 --stage_concurrency synthesize=2
+
+    POST /jobs      {"video_file": "test.mp4", "output_file": "out.mp4", "pitch": 0}
+                    -> 202 {"id": ...}, or 503 when the queue is full
+    GET  /jobs/<id> -> job status, current stage and per-stage timings
+    GET  /metrics   -> queue depth, per-stage latency and model memory
+    GET  /health
+
+DubbingClient at the bottom of this file is a minimal urllib client for it.
+"""
+import argparse
+import json
+import os
+import queue
+import socketserver
+import threading
+import time
+import traceback
+import urllib.error
+import urllib.request
+import uuid
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from pipeline import DubbingJob, DubbingPipeline
+from stage_cache import StageCache
+
+# Stages that cannot overlap inside one process: Whisper's decoder installs
+# kv-cache hooks on the shared model that replace module outputs, and
+# wav2Lip/inference.py keeps its options in module-level `args`.
+SERIAL_STAGES = ("transcribe", "lip_sync")
+# Stages that share one resident model across jobs. They run one at a time
+# unless --stage_concurrency raises the limit; the rest default to --workers.
+MODEL_STAGES = ("translate", "synthesize", "convert_voice")
+
+
+class StageStats:
+    """Rolling latency statistics for one pipeline stage."""
+
+    def __init__(self, window=200):
+        self.count = 0
+        self.total = 0.0
+        self.active = 0
+        self.recent = deque(maxlen=window)
+        self.lock = threading.Lock()
+
+    def record(self, seconds):
+        with self.lock:
+            self.count += 1
+            self.total += seconds
+            self.recent.append(seconds)
+
+    def snapshot(self):
+        with self.lock:
+            recent = sorted(self.recent)
+            count, total, active = self.count, self.total, self.active
+
+        def pct(p):
+            return recent[min(len(recent) - 1, int(p * len(recent)))] if recent else None
+
+        return {
+            "count": count,
+            "active": active,
+            "mean_s": total / count if count else None,
+            "p50_s": pct(0.50),
+            "p95_s": pct(0.95),
+            "max_s": recent[-1] if recent else None,
+        }
+
+
+class DubbingServer:
+    """Bounded job queue + worker pool in front of one resident DubbingPipeline."""
+
+    def __init__(self, pipeline=None, max_queue=16, workers=1, stage_concurrency=None,
+                 keep_finished=1000, finished_ttl=3600):
+        self.pipeline = pipeline or DubbingPipeline()
+        self.jobs_queue = queue.Queue(maxsize=max_queue)
+        self.jobs = {}
+        self.jobs_lock = threading.Lock()
+        self.workers = workers
+        # Records of finished jobs are kept for status queries, at most `keep_finished`
+        # of them and for at most `finished_ttl` seconds.
+        self.finished = deque()  # ids of done/failed jobs, oldest first
+        self.keep_finished = keep_finished
+        self.finished_ttl = finished_ttl
+
+        limits = {name: 1 if name in MODEL_STAGES else workers for name in self.pipeline.STAGES}
+        limits.update(stage_concurrency or {})
+        for name in SERIAL_STAGES:
+            limits[name] = 1
+        self.stage_slots = {name: threading.BoundedSemaphore(limit) for name, limit in limits.items()}
+        self.stage_concurrency = limits
+        self.stage_stats = {name: StageStats() for name in self.pipeline.STAGES}
+        self.started_at = time.time()
+
+    def start(self):
+        self.pipeline.load()
+        for i in range(self.workers):
+            threading.Thread(target=self._worker, name=f"dub-worker-{i}", daemon=True).start()
+
+    # ------------------------------------------------------------------ jobs
+
+    def submit(self, request):
+        """Queues a job from a request dict; returns its id, or None when the queue is full."""
+        options = dict(request)
+        job = DubbingJob(options.pop("video_file"), options.pop("output_file"), **options)
+        record = {
+            "id": uuid.uuid4().hex,
+            "status": "queued",
+            "stage": None,
+            "video_file": job.video_file,
+            "output_file": job.output_file,
+            "submitted_at": time.time(),
+            "started_at": None,
+            "finished_at": None,
+            "error": None,
+            "timings": job.timings,
+            "job": job,
+        }
+        with self.jobs_lock:
+            self._prune_finished()
+            self.jobs[record["id"]] = record
+        try:
+            self.jobs_queue.put_nowait(record)
+        except queue.Full:
+            with self.jobs_lock:
+                del self.jobs[record["id"]]
+            return None
+        return record["id"]
+
+    def status(self, job_id):
+        with self.jobs_lock:
+            record = self.jobs.get(job_id)
+        if record is None:
+            return None
+        status = {k: v for k, v in record.items() if k != "job"}
+        status["timings"] = dict(record["timings"])
+        return status
+
+    def _prune_finished(self):
+        """Forgets finished jobs beyond `keep_finished` or older than `finished_ttl`; needs `jobs_lock`."""
+        expired = time.time() - self.finished_ttl
+        while self.finished and (len(self.finished) > self.keep_finished
+                                 or self.jobs[self.finished[0]]["finished_at"] < expired):
+            del self.jobs[self.finished.popleft()]
+
+    def _worker(self):
+        while True:
+            record = self.jobs_queue.get()
+            job = record["job"]
+            record["status"] = "running"
+            record["started_at"] = time.time()
+            try:
+                for name in self.pipeline.STAGES:
+                    record["stage"] = name
+                    stats = self.stage_stats[name]
+                    with self.stage_slots[name]:
+                        with stats.lock:
+                            stats.active += 1
+                        try:
+                            self.pipeline.run_stage(name, job)
+                        finally:
+                            with stats.lock:
+                                stats.active -= 1
+                    stats.record(job.timings[name])
+                record["status"] = "done"
+            except Exception as e:
+                traceback.print_exc()
+                record["status"] = "failed"
+                record["error"] = f"{type(e).__name__}: {e}"
+            finally:
+                record["stage"] = None
+                record["finished_at"] = time.time()
+                job.release()
+                with self.jobs_lock:
+                    record["job"] = None  # the record outlives the job; keep only its status
+                    self.finished.append(record["id"])
+                    self._prune_finished()
+                self.jobs_queue.task_done()
+
+    # ------------------------------------------------------------------ metrics
+
+    def metrics(self):
+        with self.jobs_lock:
+            statuses = [r["status"] for r in self.jobs.values()]
+        memory = {"models": self.pipeline.model_memory()}
+        memory["models_total"] = sum(memory["models"].values())
+        try:
+            import torch
+            if torch.cuda.is_available():
+                memory["cuda_allocated"] = torch.cuda.memory_allocated()
+                memory["cuda_max_allocated"] = torch.cuda.max_memory_allocated()
+        except ImportError:
+            pass
+        try:
+            import resource
+            memory["max_rss"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+        except ImportError:
+            pass
+        return {
+            "uptime_s": time.time() - self.started_at,
+            "queue_depth": self.jobs_queue.qsize(),
+            "queue_capacity": self.jobs_queue.maxsize,
+            "workers": self.workers,
+            "jobs": {s: statuses.count(s) for s in ("queued", "running", "done", "failed")},
+            "stage_concurrency": self.stage_concurrency,
+            "stages": {name: stats.snapshot() for name, stats in self.stage_stats.items()},
+            "memory_bytes": memory,
+        }
+
+
+class DubbingRequestHandler(BaseHTTPRequestHandler):
+    server_version = "DubbingServer/1.0"
+
+    def _send_json(self, code, payload):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        dubbing = self.server.dubbing
+        if self.path == "/health":
+            self._send_json(200, {"ok": True})
+        elif self.path == "/metrics":
+            self._send_json(200, dubbing.metrics())
+        elif self.path.startswith("/jobs/"):
+            status = dubbing.status(self.path[len("/jobs/"):])
+            if status is None:
+                self._send_json(404, {"error": "unknown job"})
+            else:
+                self._send_json(200, status)
+        else:
+            self._send_json(404, {"error": "not found"})
+
+    def do_POST(self):
+        if self.path != "/jobs":
+            self._send_json(404, {"error": "not found"})
+            return
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            request = json.loads(self.rfile.read(length) or b"{}")
+            job_id = self.server.dubbing.submit(request)
+        except (ValueError, KeyError, TypeError) as e:
+            self._send_json(400, {"error": f"bad request: {e}"})
+            return
+        if job_id is None:
+            self._send_json(503, {"error": "queue full"})
+        else:
+            self._send_json(202, {"id": job_id})
+
+    def address_string(self):
+        # Unix-socket peers have no (host, port) address.
+        return self.client_address[0] if isinstance(self.client_address, tuple) else "unix"
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def make_http_server(dubbing, host="127.0.0.1", port=8765, socket_path=None):
+    if socket_path:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        httpd = UnixHTTPServer(socket_path, DubbingRequestHandler)
+    else:
+        httpd = ThreadingHTTPServer((host, port), DubbingRequestHandler)
+    httpd.dubbing = dubbing
+    return httpd
+
+
+class DubbingClient:
+    """Minimal client for the HTTP API, e.g. for smoke tests against a local server."""
+
+    def __init__(self, url="http://127.0.0.1:8765"):
+        self.url = url.rstrip("/")
+
+    def _request(self, method, path, payload=None):
+        data = json.dumps(payload).encode("utf-8") if payload is not None else None
+        req = urllib.request.Request(self.url + path, data=data, method=method,
+                                     headers={"Content-Type": "application/json"})
+        try:
+            with urllib.request.urlopen(req) as resp:
+                return json.loads(resp.read())
+        except urllib.error.HTTPError as e:
+            raise RuntimeError(f"{method} {path} -> {e.code}: {e.read().decode('utf-8', 'replace')}")
+
+    def submit(self, video_file, output_file, **options):
+        return self._request("POST", "/jobs", {"video_file": video_file, "output_file": output_file, **options})["id"]
+
+    def status(self, job_id):
+        return self._request("GET", f"/jobs/{job_id}")
+
+    def metrics(self):
+        return self._request("GET", "/metrics")
+
+    def wait(self, job_id, poll_interval=1.0, timeout=None):
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            status = self.status(job_id)
+            if status["status"] in ("done", "failed"):
+                return status
+            if deadline is not None and time.time() > deadline:
+                raise TimeoutError(f"Job {job_id} still {status['status']} after {timeout}s")
+            time.sleep(poll_interval)
+
+
+def parse_stage_concurrency(values):
+    limits = {}
+    for value in values:
+        name, _, limit = value.partition("=")
+        if name not in DubbingPipeline.STAGES or not limit.isdigit() or int(limit) < 1:
+            raise argparse.ArgumentTypeError(f"Expected STAGE=N with STAGE in {DubbingPipeline.STAGES}, got '{value}'")
+        limits[name] = int(limit)
+    return limits
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Dubbing daemon: keeps every model loaded and serves jobs from a queue.")
+    parser.add_argument("--host", default="127.0.0.1", help="Address to listen on.")
+    parser.add_argument("--port", type=int, default=8765, help="TCP port to listen on.")
+    parser.add_argument("--socket", default=None, help="Listen on this Unix socket instead of TCP.")
+    parser.add_argument("--max_queue", type=int, default=16, help="Jobs waiting beyond this are rejected with 503.")
+    parser.add_argument("--workers", type=int, default=1, help="Jobs processed concurrently.")
+    parser.add_argument("--stage_concurrency", nargs="*", default=[], metavar="STAGE=N",
+                        help="Per-stage concurrency limit, e.g. synthesize=2 (default: 1 for the model stages, "
+                             "--workers for ingest; transcribe and lip_sync are always 1).")
+    parser.add_argument("--keep_finished", type=int, default=1000,
+                        help="Finished jobs whose status is kept for GET /jobs/<id>.")
+    parser.add_argument("--finished_ttl", type=float, default=3600,
+                        help="Seconds a finished job's status is kept.")
+    parser.add_argument("--no-cache", dest="no_cache", action="store_true", help="Disable the stage artifact cache.")
+    parser.add_argument("--cache_size_gb", type=float, default=5, help="Stage cache size limit (LRU eviction).")
+    args = parser.parse_args()
+
+    cache = None if args.no_cache else StageCache(max_bytes=int(args.cache_size_gb * 1024 ** 3))
+    dubbing = DubbingServer(DubbingPipeline(cache=cache), max_queue=args.max_queue, workers=args.workers,
+                            stage_concurrency=parse_stage_concurrency(args.stage_concurrency),
+                            keep_finished=args.keep_finished, finished_ttl=args.finished_ttl)
+    dubbing.start()
+    httpd = make_http_server(dubbing, args.host, args.port, args.socket)
+    where = args.socket or f"http://{args.host}:{args.port}"
+    print(f"🚀 Dubbing server listening on {where} ({args.workers} worker(s), queue {args.max_queue})")
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        httpd.server_close()
+
+
+if __name__ == "__main__":
+    main()
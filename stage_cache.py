@@ -0,0 +1,133 @@
+"""
+Content-addressed cache for intermediate dubbing artifacts.
+
+Every pipeline stage output (transcript, translation, TTS wav, RVC wav, face
+boxes, mel chunks) is stored as one .npz file named after a sha256 key built
+from the input video hash, the stage parameters, the hashes of the model
+checkpoints involved and the key of the upstream stage. Changing --pitch
+therefore only invalidates RVC and everything after it, while transcription,
+translation and TTS are read back from disk.
+
+The cache is bounded by total size and evicts the least recently used entries
+(file mtime is refreshed on every hit).
+"""
+import hashlib
+import json
+import os
+import tempfile
+import threading
+from pathlib import Path
+
+import numpy as np
+
+DEFAULT_CACHE_DIR = Path(__file__).parent.resolve() / ".cache" / "stages"
+HASH_CHUNK = 1 << 20
+
+
+class StageCache:
+    def __init__(self, root=DEFAULT_CACHE_DIR, max_bytes=5 * 1024 ** 3):
+        self.root = Path(root)
+        self.max_bytes = max_bytes
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.lock = threading.Lock()
+        self._hash_index_path = self.root / "file_hashes.json"
+        try:
+            with open(self._hash_index_path, "r", encoding="utf-8") as f:
+                self._hash_index = json.load(f)
+        except (OSError, ValueError):
+            self._hash_index = {}
+
+    # ------------------------------------------------------------------ keys
+
+    @staticmethod
+    def key(*parts):
+        """sha256 over the JSON encoding of `parts` (strings, numbers, lists, dicts)."""
+        payload = json.dumps(parts, sort_keys=True, default=str).encode("utf-8")
+        return hashlib.sha256(payload).hexdigest()
+
+    def file_hash(self, path):
+        """sha256 of a file's bytes, or of every file under a directory.
+
+        Results are remembered by (path, size, mtime) so multi-GB checkpoints
+        are only read once.
+        """
+        path = Path(path).resolve()
+        if path.is_dir():
+            files = sorted(p for p in path.rglob("*") if p.is_file())
+            return self.key([(str(p.relative_to(path)), self.file_hash(p)) for p in files])
+
+        stat = path.stat()
+        memo_key = f"{path}:{stat.st_size}:{stat.st_mtime_ns}"
+        with self.lock:
+            if memo_key in self._hash_index:
+                return self._hash_index[memo_key]
+
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(HASH_CHUNK), b""):
+                digest.update(chunk)
+
+        with self.lock:
+            self._hash_index[memo_key] = digest.hexdigest()
+            self._write_atomic(self._hash_index_path, json.dumps(self._hash_index).encode("utf-8"))
+        return digest.hexdigest()
+
+    # ------------------------------------------------------------------ entries
+
+    def _entry_path(self, key):
+        return self.root / key[:2] / f"{key}.npz"
+
+    def contains(self, key):
+        return self._entry_path(key).exists()
+
+    def get(self, key):
+        """Returns the stored arrays as a dict, or None on a miss."""
+        entry = self._entry_path(key)
+        try:
+            with np.load(entry, allow_pickle=False) as data:
+                arrays = {name: data[name] for name in data.files}
+            os.utime(entry)  # mark as recently used
+        except (OSError, ValueError):
+            return None
+        return arrays
+
+    def put(self, key, **arrays):
+        entry = self._entry_path(key)
+        entry.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=entry.parent, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                np.savez(f, **{name: np.asarray(value) for name, value in arrays.items()})
+            os.replace(tmp_path, entry)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        self.evict()
+
+    def evict(self):
+        """Deletes least recently used entries until the cache fits in `max_bytes`."""
+        with self.lock:
+            entries = []
+            for entry in self.root.glob("*/*.npz"):
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry))
+            total = sum(size for _, size, _ in entries)
+            for _, size, entry in sorted(entries, key=lambda e: e[0]):
+                if total <= self.max_bytes:
+                    break
+                try:
+                    entry.unlink()
+                    total -= size
+                except OSError:
+                    pass
+
+    @staticmethod
+    def _write_atomic(path, data):
+        fd, tmp_path = tempfile.mkstemp(dir=Path(path).parent, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
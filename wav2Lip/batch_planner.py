@@ -0,0 +1,66 @@
+import os
+import torch
+
+# Planned sizes are kept for the rest of the process, keyed by model and input shape.
+planned = {}
+
+def available_memory(device):
+	"""Free bytes on `device`: CUDA free memory, or the host's available RAM."""
+	if 'cuda' in str(device):
+		return torch.cuda.mem_get_info(torch.device(device))[0]
+	try:
+		with open('/proc/meminfo') as f:
+			for line in f:
+				if line.startswith('MemAvailable:'):
+					return int(line.split()[1]) * 1024
+	except OSError:
+		pass
+	return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+
+def measure_item_bytes(module, run, inputs, device):
+	"""Memory one batch item needs while running `run(*inputs)` (inputs hold a single item).
+
+	On CUDA this is the measured peak allocation of one probe run. On CPU, where allocations are
+	not tracked, it is the size of the inputs plus every tensor produced by a leaf module of
+	`module`, which over-estimates the peak since no_grad frees most of them early.
+	"""
+	input_bytes = sum(x.numel() * x.element_size() for x in inputs)
+	with torch.no_grad():
+		if 'cuda' in str(device):
+			torch.cuda.synchronize(device)
+			torch.cuda.reset_peak_memory_stats(device)
+			base = torch.cuda.memory_allocated(device)
+			run(*inputs)
+			torch.cuda.synchronize(device)
+			return max(1, input_bytes + torch.cuda.max_memory_allocated(device) - base)
+
+		produced = [0]
+		def hook(_, __, output):
+			for x in (output if isinstance(output, (list, tuple)) else [output]):
+				if torch.is_tensor(x):
+					produced[0] += x.numel() * x.element_size()
+
+		handles = [m.register_forward_hook(hook) for m in module.modules() if not list(m.children())]
+		try:
+			run(*inputs)
+		finally:
+			for handle in handles:
+				handle.remove()
+		return max(1, input_bytes + produced[0])
+
+def plan_batch_size(key, module, run, inputs, device, max_batch, budget=None, headroom=0.7):
+	"""Largest batch size up to `max_batch` whose estimated memory fits in `budget` bytes.
+
+	`budget` defaults to `headroom` of the memory currently free on `device`. The probe runs once
+	per `key`; later calls return the size planned the first time.
+	"""
+	if key in planned:
+		return planned[key]
+	if budget is None:
+		budget = headroom * available_memory(device)
+	item_bytes = measure_item_bytes(module, run, inputs, device)
+	batch_size = int(max(1, min(max_batch, budget // item_bytes)))
+	print('Batch size for {}: {} ({:.1f} MB per item, {:.1f} MB budget)'.format(
+		key[0], batch_size, item_bytes / 2**20, budget / 2**20))
+	planned[key] = batch_size
+	return batch_size
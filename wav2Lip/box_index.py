@@ -0,0 +1,70 @@
+import hashlib, json, os, tempfile
+import numpy as np
+
+HASH_CHUNK = 1 << 20
+
+class BoxIndex:
+	"""Face boxes of one video, persisted next to it as `.<video name>.faceboxes.npz`.
+
+	Entries are keyed by the sha256 of the video bytes plus every option that changes the boxes
+	(detector, pads, crop, smoothing, ...), so lip-syncing the same video against another audio
+	track skips face detection. The content hash is remembered together with the file's size and
+	mtime, so the video is only read again when it changes.
+	"""
+	def __init__(self, video_path, params):
+		video_path = os.path.abspath(video_path)
+		self.video_path = video_path
+		self.path = os.path.join(os.path.dirname(video_path), '.{}.faceboxes.npz'.format(os.path.basename(video_path)))
+		self.entries = self._load()
+		self.key = 'boxes_' + hashlib.sha256(json.dumps([self._content_hash(), params], sort_keys=True)
+												.encode('utf-8')).hexdigest()[:16]
+
+	def _load(self):
+		try:
+			with np.load(self.path, allow_pickle=False) as data:
+				return {name: data[name] for name in data.files}
+		except (OSError, ValueError):
+			return {}
+
+	def _content_hash(self):
+		stat = os.stat(self.video_path)
+		source = np.array([stat.st_size, stat.st_mtime_ns], dtype=np.int64)
+		if np.array_equal(self.entries.get('source'), source) and 'content_hash' in self.entries:
+			return str(self.entries['content_hash'])
+
+		digest = hashlib.sha256()
+		with open(self.video_path, 'rb') as f:
+			for chunk in iter(lambda: f.read(HASH_CHUNK), b''):
+				digest.update(chunk)
+		# A changed video invalidates every entry.
+		self.entries = {'source': source, 'content_hash': np.array(digest.hexdigest())}
+		return digest.hexdigest()
+
+	def get(self, n_frames):
+		"""Boxes for the first `n_frames` frames, all boxes if the entry covers the whole video, else None."""
+		boxes = self.entries.get(self.key)
+		if boxes is None:
+			return None
+		if len(boxes) >= n_frames:
+			return boxes[:n_frames].astype(int)
+		if self.entries.get(self.key + '_complete', False):
+			return boxes.astype(int)
+		return None
+
+	def put(self, boxes, complete=False):
+		"""Stores `boxes`; `complete` marks them as covering every frame of the video."""
+		boxes = np.asarray(boxes)
+		dtype = np.int16 if boxes.size == 0 or boxes.max() < np.iinfo(np.int16).max else np.int32
+		self.entries[self.key] = boxes.astype(dtype)
+		self.entries[self.key + '_complete'] = np.array(complete)
+
+		tmp_path = None
+		try:
+			fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(self.path), suffix='.tmp')
+			with os.fdopen(fd, 'wb') as f:
+				np.savez_compressed(f, **self.entries)
+			os.replace(tmp_path, self.path)
+		except OSError as e:
+			print('Could not save the face box index to {}: {}'.format(self.path, e))
+			if tmp_path is not None and os.path.exists(tmp_path):
+				os.remove(tmp_path)
@@ -0,0 +1,256 @@
+import math
+from collections import deque
+
+import numpy as np
+
+METHODS = ('mean', 'legacy', 'one_euro')
+NO_FACE = np.array([-1, -1, -1, -1])
+
+def get_smoothened_boxes(boxes, T):
+	"""The original Wav2Lip smoothing. It averages in place, so later windows include boxes that
+	were already smoothed; kept as the 'legacy' method."""
+	for i in range(len(boxes)):
+		if i + T > len(boxes):
+			window = boxes[len(boxes) - T:]
+		else:
+			window = boxes[i : i + T]
+		boxes[i] = np.mean(window, axis=0)
+	return boxes
+
+def moving_average(boxes, T, causal=False):
+	"""O(N) moving average of an (N, 4) int array using cumulative sums.
+
+	The default window looks T-1 boxes ahead (boxes[i:i+T]); the last boxes all get the mean of
+	the final T boxes. With `causal` the window looks back instead (boxes[i-T+1:i+1]), which
+	needs no future boxes at the cost of lag.
+	"""
+	boxes = np.asarray(boxes)
+	N = len(boxes)
+	if N == 0 or T <= 1:
+		return boxes.copy()
+	T = min(T, N)
+	sums = np.concatenate((np.zeros((1, boxes.shape[1]), dtype=np.int64), np.cumsum(boxes, axis=0, dtype=np.int64)))
+	i = np.arange(N)
+	if causal:
+		start = np.maximum(0, i - T + 1)
+		end = i + 1
+	else:
+		start = np.minimum(i, N - T)
+		end = start + T
+	return ((sums[end] - sums[start]) / (end - start)[:, None]).astype(boxes.dtype)
+
+class MovingAverage:
+	"""Streaming moving_average: same boxes, released with a latency of T-1 boxes (0 when causal)."""
+	def __init__(self, T, causal=False):
+		self.T = max(1, T)
+		self.causal = causal
+		self.window = deque()
+		self.total = None
+		self.pending = 0      # boxes in the window that have not been released yet (look-ahead mode)
+
+	def push(self, box):
+		box = np.asarray(box)
+		self.window.append(box)
+		self.total = box.astype(np.int64) if self.total is None else self.total + box
+		if len(self.window) > self.T:
+			self.total -= self.window.popleft()
+
+		if self.causal:
+			return [(self.total / len(self.window)).astype(box.dtype)]
+		self.pending += 1
+		if len(self.window) == self.T:
+			self.pending -= 1
+			return [(self.total / self.T).astype(box.dtype)]
+		return []
+
+	def flush(self):
+		out = []
+		if self.window and not self.causal:
+			out = [(self.total / len(self.window)).astype(self.window[0].dtype)] * self.pending
+		self.window, self.total, self.pending = deque(), None, 0
+		return out
+
+class LegacySmoother:
+	"""Streaming get_smoothened_boxes: identical output, but each box is released as soon as
+	the T-1 boxes after it have been pushed, so only the last few boxes are ever held."""
+	def __init__(self, T):
+		self.T = T
+		self.buf = []     # most recent boxes; the first `done` entries are already smoothed
+		self.done = 0
+
+	def push(self, box):
+		self.buf.append(np.array(box))
+		out = []
+		while len(self.buf) - self.done >= self.T:
+			i = self.done
+			self.buf[i] = np.mean(self.buf[i : i + self.T], axis=0).astype(self.buf[i].dtype)
+			out.append(self.buf[i])
+			self.done += 1
+		# The tail windows of get_smoothened_boxes reach back T-1 already-smoothed boxes.
+		if self.done > self.T - 1:
+			drop = self.done - (self.T - 1)
+			del self.buf[:drop]
+			self.done -= drop
+		return out
+
+	def flush(self):
+		out = []
+		for i in range(self.done, len(self.buf)):
+			self.buf[i] = np.mean(self.buf[len(self.buf) - self.T:], axis=0).astype(self.buf[i].dtype)
+			out.append(self.buf[i])
+		self.buf, self.done = [], 0
+		return out
+
+class OneEuro:
+	"""One Euro filter (Casiez et al. 2012) on the four box coordinates; causal, no latency.
+
+	`min_cutoff` (Hz) sets the smoothing of a still face, `beta` how quickly the cutoff opens up
+	when the face moves, trading jitter for lag.
+	"""
+	def __init__(self, fps=25., min_cutoff=1., beta=0.01, d_cutoff=1.):
+		self.fps = fps
+		self.min_cutoff = min_cutoff
+		self.beta = beta
+		self.d_cutoff = d_cutoff
+		self.x = None
+		self.dx = None
+
+	def alpha(self, cutoff):
+		tau = 1. / (2 * math.pi * cutoff)
+		return 1. / (1. + tau * self.fps)
+
+	def push(self, box):
+		box = np.asarray(box)
+		value = box.astype(np.float64)
+		if self.x is None:
+			self.x, self.dx = value, np.zeros_like(value)
+		else:
+			a_d = self.alpha(self.d_cutoff)
+			self.dx = a_d * (value - self.x) * self.fps + (1 - a_d) * self.dx
+			a = self.alpha(self.min_cutoff + self.beta * np.abs(self.dx))
+			self.x = a * value + (1 - a) * self.x
+		return [np.round(self.x).astype(box.dtype)]
+
+	def flush(self):
+		self.x = self.dx = None
+		return []
+
+class NoSmoothing:
+	def push(self, box):
+		return [np.asarray(box)]
+
+	def flush(self):
+		return []
+
+def make_filter(method='mean', T=5, causal=False, fps=25., min_cutoff=1., beta=0.01):
+	"""Streaming box filter with push(box) -> released boxes and flush() -> remaining boxes."""
+	if T <= 1 and method != 'one_euro':
+		return NoSmoothing()
+	if method == 'mean':
+		return MovingAverage(T, causal)
+	if method == 'legacy':
+		return LegacySmoother(T)
+	if method == 'one_euro':
+		return OneEuro(fps, min_cutoff, beta)
+	raise ValueError('Unknown smoothing method {}, expected one of {}'.format(method, METHODS))
+
+def smooth_boxes(boxes, method='mean', T=5, causal=False, fps=25., min_cutoff=1., beta=0.01):
+	"""Smooths an (N, 4) int array of boxes over time; same result as feeding make_filter."""
+	boxes = np.asarray(boxes)
+	if method == 'mean':
+		return moving_average(boxes, T, causal)
+	if method == 'legacy':
+		return get_smoothened_boxes(boxes.copy(), T) if T > 1 else boxes.copy()
+	box_filter = make_filter(method, T, causal, fps, min_cutoff, beta)
+	out = [b for box in boxes for b in box_filter.push(box)] + box_filter.flush()
+	return np.array(out, dtype=boxes.dtype).reshape(boxes.shape)
+
+def smooth_track(boxes, *options):
+	"""smooth_boxes over each run of consecutive valid rows; rows of -1 (no face) are left as they are."""
+	boxes = np.array(boxes)
+	valid = (boxes >= 0).all(axis=1)
+	edges = np.flatnonzero(np.diff(np.concatenate(([0], valid.astype(np.int8), [0]))))
+	for start, end in zip(edges[::2], edges[1::2]):
+		boxes[start:end] = smooth_boxes(boxes[start:end], *options)
+	return boxes
+
+class GapFiller:
+	"""Fills frames where no face was found, in order, with at most `max_gap` frames of latency.
+
+	Push one (x1, y1, x2, y2) box or None per frame. A run of at most `max_gap` misses is
+	interpolated between the boxes around it (or copies the nearest box at the start/end of the
+	video); a longer run comes out as -1 rows, meaning those frames are passed through unchanged.
+	The affected frame ranges are kept in `interpolated` and `skipped`.
+	"""
+	def __init__(self, max_gap=5):
+		self.max_gap = max_gap
+		self.index = 0
+		self.last = None
+		self.missing = 0         # current run of misses not released yet
+		self.skipping = False    # the current run is longer than max_gap and is being passed through
+		self.interpolated = []
+		self.skipped = []
+
+	def _range(self, ranges, start, end):
+		if ranges and ranges[-1][1] == start - 1:
+			ranges[-1] = (ranges[-1][0], end)
+		else:
+			ranges.append((start, end))
+
+	def push(self, box):
+		index = self.index
+		self.index += 1
+		if box is None:
+			if self.skipping:
+				self._range(self.skipped, index, index)
+				return [NO_FACE]
+			self.missing += 1
+			if self.missing <= self.max_gap:
+				return []
+			self.skipping = True
+			self._range(self.skipped, index - self.missing + 1, index)
+			out = [NO_FACE] * self.missing
+			self.missing = 0
+			return out
+
+		box = np.asarray(box)
+		out = []
+		if self.missing:
+			start = index - self.missing
+			self._range(self.interpolated, start, index - 1)
+			if self.last is None:
+				out = [box.copy() for _ in range(self.missing)]
+			else:
+				steps = np.arange(1, self.missing + 1)[:, None] / float(self.missing + 1)
+				out = list((self.last + (box - self.last) * steps).astype(box.dtype))
+		self.last, self.missing, self.skipping = box, 0, False
+		return out + [box]
+
+	def flush(self):
+		out = []
+		if self.missing:
+			start = self.index - self.missing
+			if self.last is None:
+				self._range(self.skipped, start, self.index - 1)
+				out = [NO_FACE] * self.missing
+			else:
+				self._range(self.interpolated, start, self.index - 1)
+				out = [self.last.copy() for _ in range(self.missing)]
+		self.missing = 0
+		return out
+
+	def summary(self):
+		def fmt(ranges):
+			return ', '.join(str(a) if a == b else '{}-{}'.format(a, b) for a, b in ranges)
+		lines = []
+		if self.interpolated:
+			lines.append('No face detected in frames {}; boxes interpolated'.format(fmt(self.interpolated)))
+		if self.skipped:
+			lines.append('No face detected in frames {}; passed through without lip-sync'.format(fmt(self.skipped)))
+		return lines
+
+def fill_gaps(boxes, max_gap=5):
+	"""Batch GapFiller: returns the (N, 4) int array with -1 rows, and the filler for its summary."""
+	filler = GapFiller(max_gap)
+	out = [b for box in boxes for b in filler.push(box)] + filler.flush()
+	return np.array(out, dtype=int).reshape(-1, 4), filler
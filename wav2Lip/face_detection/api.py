@@ -61,9 +61,15 @@ class FaceAlignment:
                                           globals(), locals(), [face_detector], 0)
         self.face_detector = face_detector_module.FaceDetector(device=device, verbose=verbose)
 
+    def get_all_detections_for_batch(self, images, max_faces=None):
+        """Every face found in each image, as an (K, 5) array of [x1, y1, x2, y2, score] by decreasing score."""
+        images = images[..., ::-1]
+        detected_faces = self.face_detector.detect_from_batch(images.copy(), max_faces=max_faces)
+        return [np.clip(np.asarray(d, dtype=np.float32).reshape(-1, 5), 0, None) for d in detected_faces]
+
     def get_detections_for_batch(self, images):
         images = images[..., ::-1]
-        detected_faces = self.face_detector.detect_from_batch(images.copy())
+        detected_faces = self.face_detector.detect_from_batch(images.copy(), max_faces=1)
         results = []
 
         for i, d in enumerate(detected_faces):
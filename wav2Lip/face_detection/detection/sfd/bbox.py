@@ -64,6 +64,46 @@ def nms(dets, thresh):
     return keep
 
 
+try:
+    from torchvision.ops import batched_nms as _tv_batched_nms
+except (ImportError, RuntimeError):
+    # RuntimeError: torchvision built against another torch, so its C++ ops fail to register.
+    _tv_batched_nms = None
+
+
+def batched_nms(boxes, scores, idxs, thresh):
+    """NMS over boxes from many images at once; boxes only suppress boxes with the same `idxs`.
+
+    Same overlap rule as `nms` above (inclusive pixel areas, suppress when IoU > thresh).
+    Uses torchvision when it is installed and a pure torch version otherwise. Returns the kept
+    indices sorted by decreasing score.
+    """
+    if boxes.numel() == 0:
+        return torch.zeros((0,), dtype=torch.long, device=boxes.device)
+    # +1 on x2/y2 turns torchvision's areas into the inclusive (x2 - x1 + 1) areas of `nms`.
+    boxes = torch.cat((boxes[:, :2], boxes[:, 2:] + 1), 1).float()
+    scores = scores.float()
+    if _tv_batched_nms is not None:
+        return _tv_batched_nms(boxes, scores, idxs, thresh)
+
+    # Shift each image's boxes so that boxes of different images never overlap.
+    boxes = boxes + (idxs.to(boxes) * (boxes.max() + 1)).unsqueeze(1)
+    order = torch.argsort(scores, descending=True)
+    boxes = boxes[order]
+    areas = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+    suppressed = torch.zeros(len(order), dtype=torch.bool, device=boxes.device)
+    keep = []
+    for i in range(len(order)):
+        if suppressed[i]:
+            continue
+        keep.append(i)
+        lt = torch.max(boxes[i, :2], boxes[i + 1:, :2])
+        rb = torch.min(boxes[i, 2:], boxes[i + 1:, 2:])
+        inter = (rb - lt).clamp(min=0).prod(1)
+        suppressed[i + 1:] |= inter / (areas[i] + areas[i + 1:] - inter) > thresh
+    return order[keep]
+
+
 def encode(matched, priors, variances):
     """Encode the variances from the priorbox layers into the ground truth boxes
     we have matched (based on jaccard overlap) with the prior boxes.
@@ -55,43 +55,65 @@ def detect(net, img, device):
 
     return bboxlist
 
-def batch_detect(net, imgs, device):
-    imgs = imgs - np.array([104, 117, 123])
-    imgs = imgs.transpose(0, 3, 1, 2)
-
+def decode_batch(olist, threshold=0.05, variances=(0.1, 0.2)):
+    """Decodes every anchor scoring above `threshold` in a batch of S3FD outputs, on their device.
+
+    `olist` holds the (softmaxed class, regression) maps of each stride. Returns `(boxes, scores,
+    image_index)`: an (N, 4) x1y1x2y2 tensor, its (N,) scores and the (N,) batch index of each box.
+    Priors are computed from the feature-map coordinates of the selected anchors rather than
+    allocated per anchor.
+    """
+    boxes, scores, image_index = [], [], []
+    for i in range(len(olist) // 2):
+        ocls, oreg = olist[i * 2], olist[i * 2 + 1]
+        stride = 2**(i + 2)    # 4,8,16,32,64,128
+        anchor = stride * 4
+        bindex, hindex, windex = torch.nonzero(ocls[:, 1] > threshold, as_tuple=True)
+        if bindex.numel() == 0:
+            continue
+
+        loc = oreg[bindex, :, hindex, windex]
+        centers = torch.stack((windex, hindex), 1).to(loc.dtype) * stride + stride / 2
+        centers = centers + loc[:, :2] * variances[0] * anchor
+        sizes = anchor * torch.exp(loc[:, 2:] * variances[1])
+        boxes.append(torch.cat((centers - sizes / 2, centers + sizes / 2), 1))
+        scores.append(ocls[bindex, 1, hindex, windex])
+        image_index.append(bindex)
+
+    if not boxes:
+        device = olist[0].device
+        return torch.zeros((0, 4), device=device), torch.zeros((0,), device=device), \
+            torch.zeros((0,), dtype=torch.long, device=device)
+    return torch.cat(boxes), torch.cat(scores), torch.cat(image_index)
+
+def batch_forward(net, imgs, device):
+    """Runs `net` on a uint8 (B, H, W, 3) batch and returns its fp32 outputs, class maps softmaxed.
+
+    The images are copied to `device` as uint8; mean subtraction and the cast to the dtype and
+    memory format of `net`'s weights (fp16/bf16, channels_last) happen there.
+    """
     if 'cuda' in device:
         torch.backends.cudnn.benchmark = True
 
-    imgs = torch.from_numpy(imgs).float().to(device)
-    BB, CC, HH, WW = imgs.size()
+    weight = next(net.parameters())
+    channels_last = weight.is_contiguous(memory_format=torch.channels_last) and not weight.is_contiguous()
+    imgs = torch.from_numpy(np.ascontiguousarray(imgs)).to(device, non_blocking=True)
+    imgs = imgs.permute(0, 3, 1, 2).float() - torch.tensor([104., 117., 123.], device=imgs.device).view(1, 3, 1, 1)
+    imgs = imgs.to(weight.dtype).contiguous(memory_format=torch.channels_last if channels_last else torch.contiguous_format)
     with torch.no_grad():
-        olist = net(imgs)
+        olist = [o.float() for o in net(imgs)]
 
-    bboxlist = []
     for i in range(len(olist) // 2):
         olist[i * 2] = F.softmax(olist[i * 2], dim=1)
-    olist = [oelem.data.cpu() for oelem in olist]
-    for i in range(len(olist) // 2):
-        ocls, oreg = olist[i * 2], olist[i * 2 + 1]
-        FB, FC, FH, FW = ocls.size()  # feature map size
-        stride = 2**(i + 2)    # 4,8,16,32,64,128
-        anchor = stride * 4
-        poss = zip(*np.where(ocls[:, 1, :, :] > 0.05))
-        for Iindex, hindex, windex in poss:
-            axc, ayc = stride / 2 + windex * stride, stride / 2 + hindex * stride
-            score = ocls[:, 1, hindex, windex]
-            loc = oreg[:, :, hindex, windex].contiguous().view(BB, 1, 4)
-            priors = torch.Tensor([[axc / 1.0, ayc / 1.0, stride * 4 / 1.0, stride * 4 / 1.0]]).view(1, 1, 4)
-            variances = [0.1, 0.2]
-            box = batch_decode(loc, priors, variances)
-            box = box[:, 0] * 1.0
-            # cv2.rectangle(imgshow,(int(x1),int(y1)),(int(x2),int(y2)),(0,0,255),1)
-            bboxlist.append(torch.cat([box, score.unsqueeze(1)], 1).cpu().numpy())
-    bboxlist = np.array(bboxlist)
-    if 0 == len(bboxlist):
-        bboxlist = np.zeros((1, BB, 5))
+    return olist
 
-    return bboxlist
+def batch_detect(net, imgs, device):
+    """Returns one (K, 5) array of [x1, y1, x2, y2, score] candidates per image."""
+    with torch.no_grad():
+        boxes, scores, image_index = decode_batch(batch_forward(net, imgs, device))
+    dets = torch.cat((boxes, scores.unsqueeze(1)), 1).cpu().numpy()
+    image_index = image_index.cpu().numpy()
+    return [dets[image_index == b] for b in range(len(imgs))]
 
 def flip_detect(net, img, device):
     img = cv2.flip(img, 1)
@@ -1,5 +1,6 @@
 import os
 import cv2
+import torch
 from torch.utils.model_zoo import load_url
 
 from ..core import FaceDetector
@@ -38,12 +39,40 @@ class SFDDetector(FaceDetector):
 
         return bboxlist
 
-    def detect_from_batch(self, images):
-        bboxlists = batch_detect(self.face_detector, images, device=self.device)
-        keeps = [nms(bboxlists[:, i, :], 0.3) for i in range(bboxlists.shape[1])]
-        bboxlists = [bboxlists[keep, i, :] for i, keep in enumerate(keeps)]
-        bboxlists = [[x for x in bboxlist if x[-1] > 0.5] for bboxlist in bboxlists]
+    def detect_from_batch(self, images, max_faces=None, top_k=750):
+        """Returns, per image, an (K, 5) array of [x1, y1, x2, y2, score] faces by decreasing score.
 
+        Runs on the detector's device for the whole batch. Only candidates scoring above 0.5 are
+        kept, which gives the same result as filtering after NMS since a box can only be suppressed
+        by a higher-scoring one. At most `top_k` candidates per image go through NMS. With
+        `max_faces=1` the best box of each image is returned and NMS is skipped.
+        """
+        with torch.no_grad():
+            boxes, scores, image_index = decode_batch(batch_forward(self.face_detector, images, self.device))
+
+            keep = scores > 0.5
+            boxes, scores, image_index = boxes[keep], scores[keep], image_index[keep]
+
+            # Group by image, best score first; `rank` is the position of a box within its image.
+            order = torch.argsort(scores, descending=True)
+            order = order[torch.sort(image_index[order], stable=True)[1]]
+            boxes, scores, image_index = boxes[order], scores[order], image_index[order]
+            counts = torch.bincount(image_index, minlength=len(images))
+            starts = torch.cumsum(counts, 0) - counts
+            rank = torch.arange(len(image_index), device=image_index.device) - starts[image_index]
+
+            if max_faces == 1:
+                keep = rank == 0
+            else:
+                keep = torch.nonzero(rank < top_k, as_tuple=True)[0]
+                keep = keep[batched_nms(boxes[keep], scores[keep], image_index[keep], 0.3)]
+            dets = torch.cat((boxes[keep], scores[keep].unsqueeze(1)), 1).cpu().numpy()
+            image_index = image_index[keep].cpu().numpy()
+
+        bboxlists = []
+        for b in range(len(images)):
+            bboxlist = dets[image_index == b]
+            bboxlists.append(bboxlist[:max_faces] if max_faces else bboxlist)
         return bboxlists
 
     @property
@@ -0,0 +1,98 @@
+import cv2
+import numpy as np
+
+class FaceTracker:
+	"""Runs the face detector on keyframes only and tracks the face in between.
+
+	A frame is a keyframe every `detect_every` frames, on a scene cut (mean absolute difference
+	of 32x32 grayscale thumbnails above `scene_cut`) and whenever there is no face to track.
+	Between keyframes the box is moved by normalised cross-correlation of the last detected face
+	against a search region around its previous position; a match scoring below `min_score`
+	means the face drifted or changed, and that frame is sent to the detector instead. Such
+	frames are detected together in one batch per `track` call, and tracking carries on from the
+	last good match in the meantime.
+
+	State is kept across calls to `track`, so a video can be fed window by window.
+	`detect(images)` must return one (x1, y1, x2, y2) rect or None per image, like
+	FaceAlignment.get_detections_for_batch.
+	"""
+	def __init__(self, detect, detect_every=10, scene_cut=30., min_score=0.5, template_size=64):
+		self.detect = detect
+		self.detect_every = max(1, detect_every)
+		self.scene_cut = scene_cut
+		self.min_score = min_score
+		self.template_size = template_size
+
+		self.frame_index = 0
+		self.prev_thumb = None
+		self.box = None
+		self.template = None
+		self.scale = 1.
+		self.detections = 0
+
+	@staticmethod
+	def thumbnail(image):
+		return cv2.resize(cv2.cvtColor(image, cv2.COLOR_BGR2GRAY), (32, 32), interpolation=cv2.INTER_AREA).astype(np.float32)
+
+	def is_keyframe(self, image):
+		thumb = self.thumbnail(image)
+		cut = self.prev_thumb is not None and np.abs(thumb - self.prev_thumb).mean() > self.scene_cut
+		scheduled = self.frame_index % self.detect_every == 0
+		self.prev_thumb = thumb
+		self.frame_index += 1
+		return cut or scheduled
+
+	def seed(self, image, box):
+		self.box = box
+		if box is None:
+			self.template = None
+			return
+		x1, y1, x2, y2 = box
+		self.scale = min(1., float(self.template_size) / max(1, x2 - x1))
+		face = cv2.cvtColor(image[y1:y2, x1:x2], cv2.COLOR_BGR2GRAY)
+		self.template = cv2.resize(face, None, fx=self.scale, fy=self.scale, interpolation=cv2.INTER_AREA)
+
+	def follow(self, image):
+		"""Returns (box, score) of the best match for the current template in `image`."""
+		x1, y1, x2, y2 = self.box
+		w, h = x2 - x1, y2 - y1
+		sx1, sy1 = max(0, x1 - w // 2), max(0, y1 - h // 2)
+		sx2, sy2 = min(image.shape[1], x2 + w // 2), min(image.shape[0], y2 + h // 2)
+
+		region = cv2.cvtColor(image[sy1:sy2, sx1:sx2], cv2.COLOR_BGR2GRAY)
+		region = cv2.resize(region, None, fx=self.scale, fy=self.scale, interpolation=cv2.INTER_AREA)
+		th, tw = self.template.shape
+		if region.shape[0] < th or region.shape[1] < tw:
+			return self.box, -1.
+
+		scores = cv2.matchTemplate(region, self.template, cv2.TM_CCOEFF_NORMED)
+		_, score, _, (dx, dy) = cv2.minMaxLoc(scores)
+		nx1, ny1 = sx1 + int(round(dx / self.scale)), sy1 + int(round(dy / self.scale))
+		return (nx1, ny1, nx1 + w, ny1 + h), score
+
+	def track(self, images):
+		keyframes = [i for i, image in enumerate(images) if self.is_keyframe(image)]
+		detected = dict(zip(keyframes, self.detect([images[i] for i in keyframes]) if keyframes else []))
+		self.detections += len(keyframes)
+
+		boxes = [None] * len(images)
+		retry = []  # no face to follow, or a poor match
+		for i, image in enumerate(images):
+			if i in detected:
+				self.seed(image, detected[i])
+				boxes[i] = self.box
+				continue
+			box, score = self.follow(image) if self.template is not None else (None, -1.)
+			if score < self.min_score:
+				retry.append(i)
+			else:
+				self.box = boxes[i] = box
+
+		if retry:
+			for i, box in zip(retry, self.detect([images[i] for i in retry])):
+				boxes[i] = box
+			self.detections += len(retry)
+			if retry[-1] == len(images) - 1:
+				# The next window continues from this detection rather than from an older template.
+				self.seed(images[-1], boxes[-1])
+		return boxes
@@ -0,0 +1,113 @@
+import cv2
+import numpy as np
+
+def iou(a, b):
+	"""IoU matrix between (N, 4) and (M, 4) arrays of x1, y1, x2, y2 boxes."""
+	a, b = np.asarray(a, dtype=np.float64).reshape(-1, 4), np.asarray(b, dtype=np.float64).reshape(-1, 4)
+	lt = np.maximum(a[:, None, :2], b[None, :, :2])
+	rb = np.minimum(a[:, None, 2:], b[None, :, 2:])
+	inter = np.clip(rb - lt, 0, None).prod(2)
+	area_a = (a[:, 2:] - a[:, :2]).prod(1)
+	area_b = (b[:, 2:] - b[:, :2]).prod(1)
+	return inter / np.maximum(area_a[:, None] + area_b[None, :] - inter, 1e-9)
+
+class TrackLinker:
+	"""Links per-frame face detections into tracks with stable IDs by IoU with each track's last box.
+
+	Feed it frame by frame with `update`; a track that is not matched for more than `max_missing`
+	frames is closed, and a face that reappears later gets a new ID. While linking it also
+	measures how much the mouth area of each track changes between consecutive frames, which
+	`speaker` uses to pick the face that is talking.
+	"""
+	def __init__(self, iou_threshold=0.3, max_missing=5):
+		self.iou_threshold = iou_threshold
+		self.max_missing = max_missing
+		self.frames = []        # per frame: {track id: (x1, y1, x2, y2)}
+		self.active = {}        # track id: (last box, frame index it was seen, last mouth crop)
+		self.activity = {}      # track id: [summed mouth change, number of measurements]
+		self.next_id = 0
+
+	@staticmethod
+	def mouth(frame, box):
+		x1, y1, x2, y2 = box
+		w, h = x2 - x1, y2 - y1
+		region = frame[y1 + int(0.55 * h):y2, x1 + int(0.2 * w):x2 - int(0.2 * w)]
+		if region.size == 0:
+			return None
+		region = cv2.resize(cv2.cvtColor(region, cv2.COLOR_BGR2GRAY), (32, 16), interpolation=cv2.INTER_AREA)
+		region = region.astype(np.float32)
+		return (region - region.mean()) / (region.std() + 1.)
+
+	def update(self, frame, boxes):
+		"""Assigns the (x1, y1, x2, y2) `boxes` found in the next frame to tracks."""
+		index = len(self.frames)
+		for track_id in [t for t, (_, seen, _) in self.active.items() if index - seen > self.max_missing]:
+			del self.active[track_id]
+
+		ids = list(self.active)
+		assigned = {}
+		if len(boxes) and ids:
+			overlaps = iou([self.active[t][0] for t in ids], boxes)
+			for flat in np.argsort(overlaps, axis=None)[::-1]:
+				t, d = np.unravel_index(flat, overlaps.shape)
+				if overlaps[t, d] < self.iou_threshold:
+					break
+				if ids[t] not in assigned.values() and d not in assigned:
+					assigned[d] = ids[t]
+		for d in range(len(boxes)):
+			if d not in assigned:
+				assigned[d] = self.next_id
+				self.activity[self.next_id] = [0., 0]
+				self.next_id += 1
+
+		current = {}
+		for d, track_id in assigned.items():
+			box = tuple(int(v) for v in boxes[d])
+			mouth = self.mouth(frame, box)
+			previous = self.active.get(track_id)
+			if previous is not None and previous[1] == index - 1 and previous[2] is not None and mouth is not None:
+				self.activity[track_id][0] += float(np.abs(mouth - previous[2]).mean())
+				self.activity[track_id][1] += 1
+			self.active[track_id] = (box, index, mouth)
+			current[track_id] = box
+		self.frames.append(current)
+		return current
+
+	def lengths(self):
+		counts = {}
+		for current in self.frames:
+			for track_id in current:
+				counts[track_id] = counts.get(track_id, 0) + 1
+		return counts
+
+	def tracks(self, min_fraction=0.1):
+		"""IDs of the tracks present in at least `min_fraction` of the frames, in order of appearance."""
+		counts = self.lengths()
+		longest = max(counts.values()) if counts else 0
+		return [t for t in sorted(counts) if counts[t] >= min(longest, min_fraction * len(self.frames))]
+
+	def speaker(self, min_fraction=0.1):
+		"""ID of the track whose mouth area changes most from frame to frame, or None."""
+		candidates = self.tracks(min_fraction)
+		if not candidates:
+			return None
+		return max(candidates, key=lambda t: self.activity[t][0] / max(1, self.activity[t][1]))
+
+	def boxes(self, track_ids):
+		"""(N, len(track_ids), 4) int array of x1, y1, x2, y2 per frame; -1 where a track is absent."""
+		out = np.full((len(self.frames), len(track_ids), 4), -1, dtype=int)
+		for i, current in enumerate(self.frames):
+			for j, track_id in enumerate(track_ids):
+				if track_id in current:
+					out[i, j] = current[track_id]
+		return out
+
+	def summary(self):
+		counts = self.lengths()
+		lines = []
+		for track_id in sorted(counts):
+			present = [i for i, current in enumerate(self.frames) if track_id in current]
+			total, n = self.activity[track_id]
+			lines.append('face {}: frames {}-{} ({} frames), mouth activity {:.3f}'.format(
+				track_id, present[0], present[-1], counts[track_id], total / max(1, n)))
+		return lines
@@ -1,12 +1,20 @@
 from os import listdir, path
 import numpy as np
 import scipy, cv2, os, sys, argparse, audio
-import json, subprocess, random, string
+import json, subprocess, random, string, tempfile
 from tqdm import tqdm
 from glob import glob
 import torch, face_detection
+from collections import deque
+from batch_planner import plan_batch_size
+from box_index import BoxIndex
+from box_smoothing import METHODS as SMOOTHING_METHODS, GapFiller, fill_gaps, make_filter, smooth_track
+from face_tracks import TrackLinker, iou
+from face_tracking import FaceTracker
+from mel_chunks import MelChunks
 from models import Wav2Lip
-import platform
+from precision import DTYPES, module_format, prepare, reference_copy, to_device
+from video_io import Compositor, FFmpegWriter, FrameReader, IMAGE_EXTENSIONS, windows
 
 parser = argparse.ArgumentParser(description='Inference code to lip-sync videos in the wild using Wav2Lip models')
 
@@ -32,6 +40,20 @@ parser.add_argument('--face_det_batch_size', type=int,
 					help='Batch size for face detection', default=16)
 parser.add_argument('--wav2lip_batch_size', type=int, help='Batch size for Wav2Lip model(s)', default=128)
 
+parser.add_argument('--auto_batch', default=False, action='store_true',
+					help='Pick the face detection and Wav2Lip batch sizes from a memory budget, probing each model once. '
+					'--face_det_batch_size and --wav2lip_batch_size then act as upper bounds')
+parser.add_argument('--memory_budget', type=float, default=0,
+					help='Memory budget in GB for --auto_batch (default: 70%% of the free RAM/VRAM)')
+
+parser.add_argument('--precision', type=str, default='fp32', choices=sorted(DTYPES),
+					help='Compute precision of S3FD and Wav2Lip. Frames are sent to the device as uint8 and normalized there. '
+					'fp16 needs a GPU; bf16 also runs on recent CPUs')
+parser.add_argument('--channels_last', default=False, action='store_true',
+					help='Run both models in the channels_last memory format (faster convolutions on tensor-core GPUs)')
+parser.add_argument('--check_precision', default=False, action='store_true',
+					help='Compare the first face detection and Wav2Lip batch against an fp32 copy of each model and print the difference')
+
 parser.add_argument('--resize_factor', default=1, type=int, 
 			help='Reduce the resolution by this factor. Sometimes, best results are obtained at 480p or 720p')
 
@@ -49,109 +71,478 @@ parser.add_argument('--rotate', default=False, action='store_true',
 
 parser.add_argument('--nosmooth', default=False, action='store_true',
 					help='Prevent smoothing face detections over a short temporal window')
-
-args = parser.parse_args()
-args.img_size = 96
-
-if os.path.isfile(args.face) and args.face.split('.')[1] in ['jpg', 'png', 'jpeg']:
-	args.static = True
-
-def get_smoothened_boxes(boxes, T):
-	for i in range(len(boxes)):
-		if i + T > len(boxes):
-			window = boxes[len(boxes) - T:]
-		else:
-			window = boxes[i : i + T]
-		boxes[i] = np.mean(window, axis=0)
-	return boxes
-
-def face_detect(images):
-	detector = face_detection.FaceAlignment(face_detection.LandmarksType._2D, 
+parser.add_argument('--max_gap', type=int, default=5,
+					help='Frames without a detected face are filled by interpolating the boxes around them when the gap is '
+					'at most this long; longer gaps are passed through without lip-sync. A summary lists the frames')
+parser.add_argument('--strict_faces', default=False, action='store_true',
+					help='Stop with an error on the first frame without a face instead of filling gaps')
+
+parser.add_argument('--smooth', type=str, default='mean', choices=SMOOTHING_METHODS,
+					help='Face box smoothing: mean (moving average), one_euro (adaptive low-pass, less lag on motion) '
+					'or legacy (the original in-place average)')
+parser.add_argument('--smooth_window', type=int, default=5,
+					help='Moving average window in frames for --smooth mean/legacy')
+parser.add_argument('--causal_smoothing', default=False, action='store_true',
+					help='Average over past frames only, so --stream releases boxes without waiting for future frames')
+parser.add_argument('--one_euro_min_cutoff', type=float, default=1.,
+					help='One Euro minimum cutoff in Hz; lower removes more jitter from a still face')
+parser.add_argument('--one_euro_beta', type=float, default=0.01,
+					help='One Euro speed coefficient; higher reduces lag when the face moves')
+
+parser.add_argument('--faces', type=str, default='best',
+					help='Which faces to lip-sync: best (the highest-scoring face in each frame), speaker (the tracked '
+					'face whose mouth moves most), all (every tracked face, in one pass) or a face track ID as printed '
+					'by the speaker/all modes. Tracking links all detections by IoU; --detect_every is not used with it')
+
+parser.add_argument('--detect_size', type=int, default=0,
+					help='Run face detection on frames downscaled to this long side (e.g. 320-480) and scale the boxes '
+					'back up. Unlike --resize_factor the output stays at full resolution. 0 detects at full resolution')
+parser.add_argument('--detect_every', type=int, default=1,
+					help='Run the face detector only every N frames (and on scene cuts) and track the face in between. '
+					'1 detects on every frame')
+parser.add_argument('--scene_cut', type=float, default=30.,
+					help='Mean abs. difference (0-255) of 32x32 grayscale thumbnails that counts as a scene cut with --detect_every')
+parser.add_argument('--track_min_score', type=float, default=0.5,
+					help='Tracking match score below which a frame is re-detected with --detect_every')
+
+parser.add_argument('--no_box_index', default=False, action='store_true',
+					help='Do not read or write the face box index kept next to the --face video '
+					'(.<name>.faceboxes.npz), which lets repeat runs on the same video skip face detection')
+
+parser.add_argument('--stream', default=False, action='store_true',
+					help='Decode, detect and lip-sync the video window by window instead of loading every frame into memory. '
+					'Memory then depends on --stream_window and the batch sizes, not on the video length')
+parser.add_argument('--stream_window', type=int, default=128,
+					help='Frames decoded and sent to face detection at a time in --stream mode')
+
+parser.add_argument('--encoder', type=str, default='libx264',
+					help='ffmpeg video encoder for the output, e.g. libx264, h264_nvenc, libx265')
+parser.add_argument('--preset', type=str, default='medium',
+					help='Encoder preset (libx264: ultrafast ... veryslow, h264_nvenc: p1 ... p7)')
+parser.add_argument('--encoder_threads', type=int, default=0,
+					help='Encoder threads; 0 lets ffmpeg decide')
+parser.add_argument('--crf', type=int, default=18,
+					help='Constant rate factor for libx264/libx265 (lower is better quality)')
+parser.add_argument('--feather', type=int, default=0,
+					help='Blend the generated face into the frame over this many pixels at the box border (0: hard paste)')
+
+args = None
+
+def parse_args(argv=None):
+	"""Parses `argv` (default: sys.argv) into the module-level `args` used by every stage."""
+	global args
+	args = parser.parse_args(argv)
+	args.img_size = 96
+	if args.faces not in ('best', 'speaker', 'all') and not args.faces.isdigit():
+		parser.error("argument --faces: expected best, speaker, all or a face track ID, got '{}'".format(args.faces))
+
+	if os.path.isfile(args.face) and args.face.split('.')[1] in IMAGE_EXTENSIONS:
+		args.static = True
+	return args
+
+def load_detector():
+	return face_detection.FaceAlignment(face_detection.LandmarksType._2D, 
 											flip_input=False, device=device)
 
+def apply_precision(module):
+	"""Casts `module` to --precision and --channels_last; a no-op when it already is."""
+	return prepare(module, DTYPES[args.precision], args.channels_last)
+
+def reduced_precision():
+	return args.precision != 'fp32' or args.channels_last
+
+def check_detector_precision(detector, images):
+	"""Prints how far the faces found in `images` move when S3FD runs in fp32 instead of --precision."""
+	sfd = detector.face_detector
+	reduced = detector.get_all_detections_for_batch(images)
+	net, sfd.face_detector = sfd.face_detector, reference_copy(sfd.face_detector)
+	try:
+		reference = detector.get_all_detections_for_batch(images)
+	finally:
+		sfd.face_detector = net
+
+	overlaps, score_diffs, count_changes = [], [], 0
+	for ref, red in zip(reference, reduced):
+		count_changes += len(ref) != len(red)
+		if len(ref) and len(red):
+			overlaps.append(iou(ref[:1, :4], red[:1, :4])[0, 0])
+			score_diffs.append(abs(ref[0, 4] - red[0, 4]))
+	print('S3FD {} vs fp32 on {} frames: best box IoU min {:.4f}, max score diff {:.4f}, face count changed in {} frames'.format(
+		args.precision, len(images), min(overlaps, default=1.), max(score_diffs, default=0.), count_changes))
+
+def check_wav2lip_precision(model, mel_batch, img_batch):
+	"""Prints the difference (in 0-255 pixel values) between Wav2Lip in --precision and in fp32."""
+	reference = reference_copy(model)
+	with torch.no_grad():
+		pred = model(mel_batch, img_batch).float()
+		ref = reference(mel_batch.float().contiguous(), img_batch.float().contiguous())
+	diff = (pred - ref).abs() * 255.
+	print('Wav2Lip {} vs fp32 on {} faces: max abs diff {:.2f}, mean abs diff {:.3f} (0-255)'.format(
+		args.precision, len(img_batch), diff.max().item(), diff.mean().item()))
+	del reference
+
+def make_tracker(detector):
+	"""FaceTracker for --detect_every, or None when every frame is detected."""
+	if args.detect_every <= 1:
+		return None
+	return FaceTracker(lambda images: run_detector(images, detector, progress=False), args.detect_every,
+						args.scene_cut, args.track_min_score)
+
+def memory_budget():
+	return args.memory_budget * 1024**3 if args.memory_budget > 0 else None
+
+def plan_detection_batch(detector, size):
+	"""--auto_batch size for S3FD on frames of `size` (w, h)."""
+	net = detector.face_detector.face_detector
+	dtype, memory_format = module_format(net)
+	w, h = size
+	return plan_batch_size(('face detection', w, h, device, args.face_det_batch_size, args.memory_budget, args.precision),
+							net, net, [torch.zeros((1, 3, h, w), device=device, dtype=dtype).contiguous(memory_format=memory_format)], device,
+							args.face_det_batch_size, memory_budget())
+
+def plan_wav2lip_batch(model):
+	"""Sets args.wav2lip_batch_size from the memory budget (--auto_batch)."""
+	apply_precision(model)
+	dtype, memory_format = module_format(model)
+	inputs = [torch.zeros((1, 1, 80, mel_step_size), device=device, dtype=dtype),
+				torch.zeros((1, 6, args.img_size, args.img_size), device=device, dtype=dtype).contiguous(memory_format=memory_format)]
+	args.wav2lip_batch_size = plan_batch_size(('Wav2Lip', device, args.wav2lip_batch_size, args.memory_budget, args.precision),
+											model, model, inputs, device, args.wav2lip_batch_size, memory_budget())
+
+def run_detector(images, detector, progress=True, all_faces=False):
+	"""Detector results per image: a rect or None, or with `all_faces` an (K, 5) array of every face."""
 	batch_size = args.face_det_batch_size
-	
+	if not len(images):
+		return []
+
+	h, w = images[0].shape[:2]
+	scale = min(1., float(args.detect_size) / max(h, w)) if args.detect_size > 0 else 1.
+	size = (max(1, int(round(w * scale))), max(1, int(round(h * scale))))
+	apply_precision(detector.face_detector.face_detector)
+	if args.auto_batch:
+		batch_size = plan_detection_batch(detector, size)
+
 	while 1:
 		predictions = []
 		try:
-			for i in tqdm(range(0, len(images), batch_size)):
-				predictions.extend(detector.get_detections_for_batch(np.array(images[i:i + batch_size])))
+			for i in tqdm(range(0, len(images), batch_size), disable=not progress):
+				batch = images[i:i + batch_size]
+				if scale < 1:
+					batch = [cv2.resize(image, size, interpolation=cv2.INTER_AREA) for image in batch]
+				if i == 0 and progress and args.check_precision and reduced_precision():
+					check_detector_precision(detector, np.array(batch))
+				if all_faces:
+					predictions.extend(detector.get_all_detections_for_batch(np.array(batch)))
+				else:
+					predictions.extend(detector.get_detections_for_batch(np.array(batch)))
 		except RuntimeError:
+			if args.auto_batch:
+				raise
 			if batch_size == 1: 
-				raise RuntimeError('Image too big to run face detection on GPU. Please use the --resize_factor argument')
+				raise RuntimeError('Image too big to run face detection on GPU. Please use the --detect_size or --resize_factor argument')
 			batch_size //= 2
 			print('Recovering from OOM error; New batch size: {}'.format(batch_size))
 			continue
 		break
 
-	results = []
+	if scale < 1:
+		sx, sy = float(w) / size[0], float(h) / size[1]
+		def rescale(rect):
+			return (int(rect[0] * sx), int(rect[1] * sy), min(w, int(round(rect[2] * sx))), min(h, int(round(rect[3] * sy))))
+		if all_faces:
+			predictions = [np.array([rescale(d) + (d[4],) for d in dets]).reshape(-1, 5) for dets in predictions]
+		else:
+			predictions = [None if rect is None else rescale(rect) for rect in predictions]
+	return predictions
+
+def pad_rect(rect, image):
 	pady1, pady2, padx1, padx2 = args.pads
+	return [max(0, int(rect[0]) - padx1), max(0, int(rect[1]) - pady1),
+			min(image.shape[1], int(rect[2]) + padx2), min(image.shape[0], int(rect[3]) + pady2)]
+
+def detect_raw_boxes(images, detector, tracker=None):
+	"""Padded, unsmoothed (x1, y1, x2, y2) face box per image, None where no face was found.
+
+	`tracker` (see make_tracker) carries keyframe/tracking state across calls in --stream mode.
+	"""
+	if tracker is None:
+		tracker = make_tracker(detector)
+	if tracker is not None:
+		predictions = tracker.track(images)
+		print('Ran face detection on {} of {} frames'.format(tracker.detections, tracker.frame_index))
+	else:
+		predictions = run_detector(images, detector)
+
+	results = []
 	for rect, image in zip(predictions, images):
+		if rect is None and not args.strict_faces:
+			results.append(None)
+			continue
 		if rect is None:
-			cv2.imwrite('temp/faulty_frame.jpg', image) # check this frame where the face was not detected.
-			raise ValueError('Face not detected! Ensure the video contains a face in all the frames.')
-
-		y1 = max(0, rect[1] - pady1)
-		y2 = min(image.shape[0], rect[3] + pady2)
-		x1 = max(0, rect[0] - padx1)
-		x2 = min(image.shape[1], rect[2] + padx2)
-		
-		results.append([x1, y1, x2, y2])
-
-	boxes = np.array(results)
-	if not args.nosmooth: boxes = get_smoothened_boxes(boxes, T=5)
-	results = [[image[y1: y2, x1:x2], (y1, y2, x1, x2)] for image, (x1, y1, x2, y2) in zip(images, boxes)]
+			fd, faulty_frame = tempfile.mkstemp(prefix='faulty_frame_', suffix='.jpg')
+			os.close(fd)
+			cv2.imwrite(faulty_frame, image) # check this frame where the face was not detected.
+			raise ValueError('Face not detected! Ensure the video contains a face in all the frames. '
+							'The first frame without a face was saved to {}'.format(faulty_frame))
+
+		results.append(pad_rect(rect, image))
+
+	return results
+
+def smoothing_options():
+	"""(method, T, causal, fps, min_cutoff, beta) for box_smoothing from the command line."""
+	if args.nosmooth:
+		return ('mean', 1, False, args.fps, args.one_euro_min_cutoff, args.one_euro_beta)
+	return (args.smooth, args.smooth_window, args.causal_smoothing,
+			args.fps, args.one_euro_min_cutoff, args.one_euro_beta)
+
+def face_detect(images, detector=None):
+	if detector is None:
+		detector = load_detector()
+
+	boxes, filler = fill_gaps(detect_raw_boxes(images, detector), args.max_gap)
+	for line in filler.summary():
+		print(line)
+	boxes = smooth_track(boxes, *smoothing_options())
+	results = [[image[y1: y2, x1:x2] if y1 >= 0 else None, (y1, y2, x1, x2)]
+				for image, (x1, y1, x2, y2) in zip(images, boxes)]
 
 	del detector
 	return results 
 
-def datagen(frames, mels):
-	img_batch, mel_batch, frame_batch, coords_batch = [], [], [], []
-
-	if args.box[0] == -1:
-		if not args.static:
-			face_det_results = face_detect(frames) # BGR2RGB for CNN face detection
-		else:
-			face_det_results = face_detect([frames[0]])
+def track_faces(frame_windows, detector=None):
+	"""Face boxes for --faces speaker/all/ID, from every face detected in the frames of `frame_windows`.
+
+	Returns (y1, y2, x1, x2) rows like get_face_boxes, (N, 4) for one face or (N, F, 4) for
+	--faces all; rows of -1 mark frames where that face is not visible (they are passed through).
+	"""
+	if detector is None:
+		detector = load_detector()
+	linker = TrackLinker()
+	for window in frame_windows:
+		for image, dets in zip(window, run_detector(window, detector, all_faces=True)):
+			linker.update(image, [pad_rect(d, image) for d in dets])
+
+	print('Face tracks:')
+	for line in linker.summary():
+		print('  ' + line)
+	if args.faces == 'all':
+		track_ids = linker.tracks()
+	elif args.faces == 'speaker':
+		track_ids = [linker.speaker()]
+		print('Lip-syncing the speaking face {}'.format(track_ids[0]))
 	else:
+		track_ids = [int(args.faces)]
+	if not track_ids or track_ids[0] is None or any(t not in linker.lengths() for t in track_ids):
+		raise ValueError('No face track {} found in the video'.format(args.faces))
+
+	boxes = linker.boxes(track_ids)
+	for j in range(boxes.shape[1]):
+		boxes[:, j] = smooth_track(boxes[:, j], *smoothing_options())
+	boxes = np.where(boxes >= 0, boxes[..., [1, 3, 0, 2]], -1)
+	return boxes[:, 0] if args.faces != 'all' else boxes
+
+def open_box_index():
+	"""BoxIndex for args.face and every option that affects its boxes, or None when it does not apply."""
+	if args.no_box_index or args.box[0] != -1 or not os.path.isfile(args.face):
+		return None
+	detector_path = path.join(path.dirname(path.abspath(__file__)), 'face_detection', 'detection', 'sfd', 's3fd.pth')
+	params = {
+		'detector': 's3fd',
+		'detector_size': path.getsize(detector_path) if path.isfile(detector_path) else None,
+		'pads': args.pads, 'resize_factor': args.resize_factor, 'rotate': args.rotate, 'crop': args.crop,
+		'static': args.static, 'max_gap': args.max_gap, 'strict_faces': args.strict_faces, 'nosmooth': args.nosmooth, 'smoothing': smoothing_options(), 'faces': args.faces,
+		'precision': args.precision, 'channels_last': args.channels_last, 'detect_size': args.detect_size, 'detect_every': args.detect_every, 'scene_cut': args.scene_cut, 'track_min_score': args.track_min_score,
+	}
+	return BoxIndex(args.face, params)
+
+def get_face_boxes(frames, detector=None):
+	"""Returns an int array of (y1, y2, x1, x2) face boxes, one row per frame (a single row with --static)."""
+	if args.box[0] != -1:
 		print('Using the specified bounding box instead of face detection...')
-		y1, y2, x1, x2 = args.box
-		face_det_results = [[f[y1: y2, x1:x2], (y1, y2, x1, x2)] for f in frames]
-
-	for i, m in enumerate(mels):
-		idx = 0 if args.static else i%len(frames)
-		frame_to_save = frames[idx].copy()
-		face, coords = face_det_results[idx].copy()
-
-		face = cv2.resize(face, (args.img_size, args.img_size))
-			
-		img_batch.append(face)
-		mel_batch.append(m)
-		frame_batch.append(frame_to_save)
-		coords_batch.append(coords)
+		return np.tile(np.array(args.box, dtype=int), (len(frames), 1))
 
-		if len(img_batch) >= args.wav2lip_batch_size:
-			img_batch, mel_batch = np.asarray(img_batch), np.asarray(mel_batch)
+	index = open_box_index()
+	if index is not None:
+		boxes = index.get(1 if args.static else len(frames))
+		if boxes is not None:
+			print('Loaded face boxes from {}'.format(index.path))
+			return boxes
 
-			img_masked = img_batch.copy()
-			img_masked[:, args.img_size//2:] = 0
+	if args.faces != 'best':
+		boxes = track_faces(windows(frames[:1] if args.static else frames, args.face_det_batch_size), detector)
+	else:
+		if not args.static:
+			face_det_results = face_detect(frames, detector) # BGR2RGB for CNN face detection
+		else:
+			face_det_results = face_detect([frames[0]], detector)
+		boxes = np.array([coords for _, coords in face_det_results], dtype=int)
 
-			img_batch = np.concatenate((img_masked, img_batch), axis=3) / 255.
-			mel_batch = np.reshape(mel_batch, [len(mel_batch), mel_batch.shape[1], mel_batch.shape[2], 1])
+	if index is not None:
+		index.put(boxes)
+	return boxes
 
-			yield img_batch, mel_batch, frame_batch, coords_batch
-			img_batch, mel_batch, frame_batch, coords_batch = [], [], [], []
+def datagen(frames, mels, detector=None, face_boxes=None):
+	if face_boxes is None:
+		face_boxes = get_face_boxes(frames, detector)
+
+	def frames_and_boxes():
+		for i in range(len(mels)):
+			idx = 0 if args.static else i%len(frames)
+			yield frames[idx], face_boxes[idx]
+
+	return batch_gen(frames_and_boxes(), mels)
+
+def stream_frames_and_boxes(reader, n_frames, detector=None, face_boxes=None, cycle=True):
+	"""Streaming counterpart of datagen's frame/box lookup.
+
+	Yields `(frame, (y1, y2, x1, x2))` for output frames 0..n_frames-1, decoding and detecting
+	--stream_window frames at a time. Like datagen, the video is cycled if it is shorter than
+	the audio; the boxes found on the first pass are reused for the repeats. With `cycle` False
+	it stops at the end of the video instead.
+	"""
+	if args.static:
+		frame = next(iter(reader))
+		box = face_boxes[0] if face_boxes is not None else get_face_boxes([frame], detector)[0]
+		for _ in range(n_frames):
+			yield frame, box
+		return
+
+	boxes = face_boxes
+	if boxes is None and args.box[0] != -1:
+		print('Using the specified bounding box instead of face detection...')
+		boxes = [np.array(args.box, dtype=int)]
 
-	if len(img_batch) > 0:
-		img_batch, mel_batch = np.asarray(img_batch), np.asarray(mel_batch)
+	index = open_box_index() if boxes is None else None
+	if index is not None:
+		boxes = index.get(n_frames)
+		if boxes is not None:
+			print('Loaded face boxes from {}'.format(index.path))
 
-		img_masked = img_batch.copy()
-		img_masked[:, args.img_size//2:] = 0
+	if boxes is None and args.faces != 'best':
+		boxes = track_faces(windows(reader, args.stream_window, limit=n_frames), detector)
+		if index is not None:
+			index.put(boxes, complete=len(boxes) < n_frames)
+
+	i = 0
+	if boxes is None:
+		if detector is None:
+			detector = load_detector()
+		boxes = []
+		pending = deque()
+		filler = GapFiller(args.max_gap)
+		smoother = make_filter(*smoothing_options())
+		tracker = make_tracker(detector)
+
+		def release(filled):
+			# Smoothing runs per stretch of frames with a face, like smooth_track.
+			for box in filled:
+				smoothed = smoother.flush() + [box] if box[0] < 0 else smoother.push(box)
+				for x1, y1, x2, y2 in smoothed:
+					boxes.append(np.array([y1, y2, x1, x2]) if y1 >= 0 else np.array([-1, -1, -1, -1]))
+					yield pending.popleft(), boxes[-1]
+
+		for window in windows(reader, args.stream_window, limit=n_frames):
+			for frame, rect in zip(window, detect_raw_boxes(window, detector, tracker)):
+				pending.append(frame)
+				yield from release(filler.push(rect))
+		yield from release(filler.flush())
+		for x1, y1, x2, y2 in smoother.flush():
+			boxes.append(np.array([y1, y2, x1, x2]))
+			yield pending.popleft(), boxes[-1]
+		for line in filler.summary():
+			print(line)
+
+		i = len(boxes)
+		if index is not None:
+			index.put(np.array(boxes, dtype=int), complete=i < n_frames)
+
+	while i < n_frames and (cycle or i == 0):
+		start = i
+		for idx, frame in enumerate(reader):
+			if i >= n_frames:
+				break
+			yield frame, boxes[idx % len(boxes)]
+			i += 1
+		if i == start:
+			raise ValueError('No frames could be read from the video')
+
+def stream_face_boxes(reader, n_frames, detector=None):
+	"""get_face_boxes for the first `n_frames` of `reader`, detecting --stream_window frames at a time
+	instead of holding every frame in memory."""
+	if args.box[0] != -1:
+		return np.tile(np.array(args.box, dtype=int), (n_frames, 1))
+	boxes = np.array([box for _, box in stream_frames_and_boxes(reader, n_frames, detector, cycle=False)], dtype=int)
+	# When the video is shorter than `n_frames`, repeat its boxes rather than decoding it again.
+	return boxes[np.arange(n_frames) % len(boxes)]
+
+def batch_gen(frames_and_boxes, mels):
+	"""Batches of `(img_batch, mel_batch, frames, coords)` for render().
+
+	A box may be one (y1, y2, x1, x2) row or an (F, 4) array for several faces; rows of -1 mean
+	no face, and such frames are passed through unchanged. coords[i] lists the face boxes of
+	frames[i], in the order their images appear in img_batch (which is None for a batch without
+	faces). Batches end on frame boundaries.
+
+	img_batch is a uint8 (B, img_size, img_size, 6) view of one reused buffer (pinned on CUDA),
+	holding the masked face and the face, and mel_batch a (B, 80, 16, 1) float32 view of another;
+	both are only valid until the next batch is requested. `mels` is a MelChunks or a list of
+	(80, 16) chunks, one per frame.
+	"""
+	if not isinstance(mels, MelChunks):
+		mels = MelChunks.from_chunks(mels)
+	half = args.img_size // 2
+	faces = mel_buffer = None    # (capacity, img_size, img_size, 6) uint8 and (capacity, 80, 16) float32
+	n_faces = 0
+	mel_index, frame_batch, coords_batch = [], [], []
+
+	def pinned(shape, dtype):
+		buffer = torch.zeros(shape, dtype=dtype)
+		return (buffer.pin_memory() if 'cuda' in str(device) else buffer).numpy()
+
+	def reserve(n):
+		"""Makes room for `n` faces; several faces per frame may take a batch past wav2lip_batch_size."""
+		nonlocal faces, mel_buffer
+		if faces is not None and len(faces) >= n:
+			return
+		capacity = max(n, args.wav2lip_batch_size)
+		buffer = pinned((capacity, args.img_size, args.img_size, 6), torch.uint8)
+		if faces is not None:
+			buffer[:n_faces] = faces[:n_faces]
+		faces = buffer
+		mel_buffer = pinned((capacity,) + mels.windows.shape[1:], torch.float32)
+
+	def make_batch():
+		if not n_faces:
+			return None, None, frame_batch, coords_batch
+		mel = mels.gather(mel_index, out=mel_buffer[:n_faces])
+		return faces[:n_faces], mel[..., np.newaxis], frame_batch, coords_batch
+
+	for i, (frame, box) in zip(range(len(mels)), frames_and_boxes):
+		coords = []
+		for face_box in np.asarray(box).reshape(-1, 4):
+			if face_box[0] < 0:
+				continue
+			y1, y2, x1, x2 = face_coords = tuple(int(v) for v in face_box)
+			face = frame[y1: y2, x1:x2]
+
+			reserve(n_faces + 1)
+			faces[n_faces, :, :, 3:] = cv2.resize(face, (args.img_size, args.img_size))
+			# The masked copy is the top half of the face; its lower half stays zero from allocation.
+			faces[n_faces, :half, :, :3] = faces[n_faces, :half, :, 3:]
+			n_faces += 1
+
+			mel_index.append(i)
+			coords.append(face_coords)
+		frame_batch.append(frame) # a reference: render() patches the faces in place only while writing
+		coords_batch.append(coords)
 
-		img_batch = np.concatenate((img_masked, img_batch), axis=3) / 255.
-		mel_batch = np.reshape(mel_batch, [len(mel_batch), mel_batch.shape[1], mel_batch.shape[2], 1])
+		if n_faces >= args.wav2lip_batch_size or len(frame_batch) >= args.wav2lip_batch_size:
+			yield make_batch()
+			n_faces, mel_index, frame_batch, coords_batch = 0, [], [], []
 
-		yield img_batch, mel_batch, frame_batch, coords_batch
+	if len(frame_batch) > 0:
+		yield make_batch()
 
 mel_step_size = 16
 device = 'cuda' if torch.cuda.is_available() else 'cpu'
@@ -178,103 +569,137 @@ def load_model(path):
 	model = model.to(device)
 	return model.eval()
 
-def main():
-	if not os.path.isfile(args.face):
+def open_reader(face):
+	if not os.path.isfile(face):
 		raise ValueError('--face argument must be a valid path to video/image file')
-
-	elif args.face.split('.')[1] in ['jpg', 'png', 'jpeg']:
-		full_frames = [cv2.imread(args.face)]
-		fps = args.fps
-
-	else:
-		video_stream = cv2.VideoCapture(args.face)
-		fps = video_stream.get(cv2.CAP_PROP_FPS)
-
+	reader = FrameReader(face, args.resize_factor, args.rotate, args.crop, args.fps)
+	args.fps = reader.fps # the One Euro box filter runs at the video frame rate
+	return reader
+
+def read_frames(face):
+	"""Returns `(full_frames, fps)` for a video or still image, with --resize_factor/--rotate/--crop applied."""
+	reader = open_reader(face)
+	if not reader.is_image:
 		print('Reading video frames...')
-
-		full_frames = []
-		while 1:
-			still_reading, frame = video_stream.read()
-			if not still_reading:
-				video_stream.release()
-				break
-			if args.resize_factor > 1:
-				frame = cv2.resize(frame, (frame.shape[1]//args.resize_factor, frame.shape[0]//args.resize_factor))
-
-			if args.rotate:
-				frame = cv2.rotate(frame, cv2.cv2.ROTATE_90_CLOCKWISE)
-
-			y1, y2, x1, x2 = args.crop
-			if x2 == -1: x2 = frame.shape[1]
-			if y2 == -1: y2 = frame.shape[0]
-
-			frame = frame[y1:y2, x1:x2]
-
-			full_frames.append(frame)
+	full_frames = list(reader)
 
 	print ("Number of frames available for inference: "+str(len(full_frames)))
+	return full_frames, reader.fps
 
-	if not args.audio.endswith('.wav'):
-		print('Extracting raw audio...')
-		command = 'ffmpeg -y -i {} -strict -2 {}'.format(args.audio, 'temp/temp.wav')
-
-		subprocess.call(command, shell=True)
-		args.audio = 'temp/temp.wav'
-
-	wav = audio.load_wav(args.audio, 16000)
+def get_mel_chunks(wav, fps):
 	mel = audio.melspectrogram(wav)
 	print(mel.shape)
 
 	if np.isnan(mel.reshape(-1)).sum() > 0:
 		raise ValueError('Mel contains nan! Using a TTS voice? Add a small epsilon noise to the wav file and try again')
 
-	mel_chunks = []
-	mel_idx_multiplier = 80./fps 
-	i = 0
-	while 1:
-		start_idx = int(i * mel_idx_multiplier)
-		if start_idx + mel_step_size > len(mel[0]):
-			mel_chunks.append(mel[:, len(mel[0]) - mel_step_size:])
-			break
-		mel_chunks.append(mel[:, start_idx : start_idx + mel_step_size])
-		i += 1
+	mel_chunks = MelChunks.for_fps(mel, fps, mel_step_size)
 
 	print("Length of mel chunks: {}".format(len(mel_chunks)))
+	return mel_chunks
 
-	full_frames = full_frames[:len(mel_chunks)]
-
+def render(gen, n_frames, fps, audio_path, outfile, model=None):
+	"""Runs Wav2Lip over the batches from `gen`, writes the frames and muxes them with `audio_path`."""
 	batch_size = args.wav2lip_batch_size
-	gen = datagen(full_frames.copy(), mel_chunks)
-
-	for i, (img_batch, mel_batch, frames, coords) in enumerate(tqdm(gen, 
-											total=int(np.ceil(float(len(mel_chunks))/batch_size)))):
-		if i == 0:
-			model = load_model(args.checkpoint_path)
-			print ("Model loaded")
-
-			frame_h, frame_w = full_frames[0].shape[:-1]
-			out = cv2.VideoWriter('temp/result.avi', 
-									cv2.VideoWriter_fourcc(*'DIVX'), fps, (frame_w, frame_h))
-
-		img_batch = torch.FloatTensor(np.transpose(img_batch, (0, 3, 1, 2))).to(device)
-		mel_batch = torch.FloatTensor(np.transpose(mel_batch, (0, 3, 1, 2))).to(device)
-
-		with torch.no_grad():
-			pred = model(mel_batch, img_batch)
+	compositor = Compositor(args.feather)
+
+	out = None  # opened with the first batch, once the frame size is known
+	try:
+		for i, (img_batch, mel_batch, frames, coords) in enumerate(tqdm(gen, 
+												total=int(np.ceil(float(n_frames)/batch_size)))):
+			if i == 0:
+				if model is None:
+					model = load_model(args.checkpoint_path)
+					print ("Model loaded")
+				apply_precision(model)
+				dtype, memory_format = module_format(model)
+
+				frame_h, frame_w = frames[0].shape[:-1]
+				out = FFmpegWriter(outfile, audio_path, fps, (frame_w, frame_h),
+								encoder=args.encoder, preset=args.preset, threads=args.encoder_threads, crf=args.crf)
+
+			if img_batch is not None:
+				img_batch = to_device(img_batch, device, dtype, memory_format, std=255.)
+				mel_batch = to_device(mel_batch, device, dtype)
+				if i == 0 and args.check_precision and reduced_precision():
+					check_wav2lip_precision(model, mel_batch, img_batch)
+
+				with torch.no_grad():
+					pred = model(mel_batch, img_batch)
+
+				pred = pred.float().cpu().numpy().transpose(0, 2, 3, 1) * 255.
+
+			p = 0
+			for f, c in zip(frames, coords):
+				compositor.write(out, f, list(zip(c, pred[p:p + len(c)])) if c else [])
+				p += len(c)
+
+		if out is None:
+			raise RuntimeError('No frames to lip-sync for {}'.format(outfile))
+	except BaseException:
+		# Don't leave an ffmpeg process behind or a truncated video at `outfile`.
+		if out is not None:
+			out.abort()
+		raise
+	out.close()
+
+def lip_sync(full_frames, fps, wav, audio_path, outfile, model=None, detector=None, face_boxes=None, mel_chunks=None):
+	"""Lip-syncs `full_frames` to the 16 kHz `wav` and muxes the result with `audio_path` into `outfile`.
+
+	`model` and `detector` may be passed in by callers that keep them loaded across runs, and
+	`face_boxes` (see get_face_boxes) / `mel_chunks` (see get_mel_chunks) by callers that cached them.
+	"""
+	if mel_chunks is None:
+		mel_chunks = get_mel_chunks(wav, fps)
 
-		pred = pred.cpu().numpy().transpose(0, 2, 3, 1) * 255.
-		
-		for p, f, c in zip(pred, frames, coords):
-			y1, y2, x1, x2 = c
-			p = cv2.resize(p.astype(np.uint8), (x2 - x1, y2 - y1))
-
-			f[y1:y2, x1:x2] = p
-			out.write(f)
+	full_frames = full_frames[:len(mel_chunks)]
+	if args.auto_batch:
+		model = model or load_model(args.checkpoint_path)
+		plan_wav2lip_batch(model)
+
+	gen = datagen(full_frames, mel_chunks, detector, face_boxes)
+	render(gen, len(mel_chunks), fps, audio_path, outfile, model)
+
+def stream_lip_sync(reader, wav, audio_path, outfile, model=None, detector=None, face_boxes=None, mel_chunks=None):
+	"""Same as lip_sync, but frames come from `reader` (anything re-iterable with an `fps`) window by window.
+
+	Peak memory is bounded by --stream_window and the batch sizes rather than by the video length.
+	Without `face_boxes` the faces are detected in the same pass over the video. Returns the face
+	box of every output frame, so callers can cache them as `face_boxes` for later runs.
+	"""
+	if mel_chunks is None:
+		mel_chunks = get_mel_chunks(wav, reader.fps)
+	if args.auto_batch:
+		model = model or load_model(args.checkpoint_path)
+		plan_wav2lip_batch(model)
+
+	boxes = []
+	def frames_and_boxes():
+		for frame, box in stream_frames_and_boxes(reader, len(mel_chunks), detector, face_boxes):
+			boxes.append(box)
+			yield frame, box
+
+	gen = batch_gen(frames_and_boxes(), mel_chunks)
+	render(gen, len(mel_chunks), reader.fps, audio_path, outfile, model)
+	return np.array(boxes, dtype=int)
 
-	out.release()
+def main():
+	if not args.audio.endswith('.wav'):
+		print('Extracting raw audio...')
+		with tempfile.TemporaryDirectory() as tmp_dir:
+			command = ['ffmpeg', '-y', '-i', args.audio, '-strict', '-2', path.join(tmp_dir, 'temp.wav')]
+			subprocess.call(command)
+			wav = audio.load_wav(path.join(tmp_dir, 'temp.wav'), 16000)
+	else:
+		wav = audio.load_wav(args.audio, 16000)
 
-	command = 'ffmpeg -y -i {} -i {} -strict -2 -q:v 1 {}'.format(args.audio, 'temp/result.avi', args.outfile)
-	subprocess.call(command, shell=platform.system() != 'Windows')
+	# The output is muxed straight from args.audio, which ffmpeg reads in any format.
+	if args.stream:
+		stream_lip_sync(open_reader(args.face), wav, args.audio, args.outfile)
+	else:
+		full_frames, fps = read_frames(args.face)
+		lip_sync(full_frames, fps, wav, args.audio, args.outfile)
 
 if __name__ == '__main__':
+	parse_args()
 	main()
@@ -0,0 +1,54 @@
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+def chunk_starts(n_mel, fps, step=16):
+	"""Start column of the mel window of each video frame.
+
+	Frame i starts at int(i * 80 / fps); the first window that would run past the end of the
+	spectrogram is clamped to the last `step` columns and is the final one.
+	"""
+	if n_mel < step:
+		raise ValueError('Audio too short: {} mel frames, at least {} needed'.format(n_mel, step))
+	multiplier = 80. / fps
+	count = int(np.ceil((n_mel - step + 1) / multiplier)) + 2
+	starts = (np.arange(count) * multiplier).astype(np.int64)
+	last = np.flatnonzero(starts + step > n_mel)[0]
+	starts = starts[:last + 1]
+	starts[last] = n_mel - step
+	return starts
+
+class MelChunks:
+	"""The (80, step) mel window of every video frame as strided views of one spectrogram.
+
+	`chunks[i]` is a view, nothing is copied per frame; `gather` copies the windows of several
+	frames into one (B, 80, step) array, e.g. a preallocated batch buffer.
+	"""
+	def __init__(self, mel, starts, step=16):
+		self.mel = np.ascontiguousarray(mel, dtype=np.float32)
+		self.starts = np.asarray(starts, dtype=np.int64)
+		self.step = step
+		# (n_mel - step + 1, 80, step): every window position, as a view of self.mel
+		self.windows = np.moveaxis(sliding_window_view(self.mel, step, axis=1), 1, 0)
+
+	@classmethod
+	def for_fps(cls, mel, fps, step=16):
+		return cls(mel, chunk_starts(mel.shape[1], fps, step), step)
+
+	@classmethod
+	def from_chunks(cls, chunks):
+		"""Wraps a list of (80, step) arrays, laid end to end."""
+		step = np.shape(chunks[0])[1]
+		return cls(np.concatenate(chunks, axis=1), np.arange(len(chunks)) * step, step)
+
+	def __len__(self):
+		return len(self.starts)
+
+	def __getitem__(self, i):
+		return self.windows[self.starts[i]]
+
+	def __iter__(self):
+		return (self.windows[s] for s in self.starts)
+
+	def gather(self, indices, out=None):
+		"""Windows of the frames in `indices` as one (len(indices), 80, step) float32 array, written to `out` if given."""
+		return np.take(self.windows, self.starts[np.asarray(indices, dtype=np.int64)], axis=0, out=out, mode='clip')
@@ -0,0 +1,38 @@
+import copy
+import torch
+
+DTYPES = {'fp32': torch.float32, 'fp16': torch.float16, 'bf16': torch.bfloat16}
+
+def prepare(module, dtype=torch.float32, channels_last=False):
+	"""Casts `module` in place to `dtype` and the channels_last (or default) memory format, if it is not already."""
+	params = list(module.parameters())
+	if params and params[0].dtype != dtype:
+		module.to(dtype)
+	convs = [p for p in params if p.dim() == 4]
+	memory_format = torch.channels_last if channels_last else torch.contiguous_format
+	if convs and not convs[0].is_contiguous(memory_format=memory_format):
+		module.to(memory_format=memory_format)
+	return module
+
+def module_format(module):
+	"""(dtype, memory_format) that inputs of `module` should be given in."""
+	params = list(module.parameters())
+	convs = [p for p in params if p.dim() == 4]
+	channels_last = bool(convs) and convs[0].is_contiguous(memory_format=torch.channels_last) \
+		and not convs[0].is_contiguous()
+	return params[0].dtype, torch.channels_last if channels_last else torch.contiguous_format
+
+def to_device(batch, device, dtype=torch.float32, memory_format=torch.contiguous_format, std=None):
+	"""(B, H, W, C) numpy batch -> (B, C, H, W) tensor in `dtype` on `device`, divided by `std`.
+
+	The array is copied as it is (uint8 images stay uint8); the permute, the normalization (in
+	fp32) and the cast happen on `device`.
+	"""
+	x = torch.from_numpy(batch).to(device, non_blocking=True).permute(0, 3, 1, 2).float()
+	if std is not None:
+		x = x / std
+	return x.to(dtype).contiguous(memory_format=memory_format)
+
+def reference_copy(module):
+	"""fp32, default-layout copy of `module` for accuracy checks."""
+	return prepare(copy.deepcopy(module), torch.float32, False)
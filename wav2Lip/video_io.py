@@ -0,0 +1,165 @@
+import cv2, os, subprocess
+import numpy as np
+
+IMAGE_EXTENSIONS = ['jpg', 'png', 'jpeg']
+
+class FrameReader:
+	"""Decodes a video (or a still image) one frame at a time.
+
+	Applies the same --resize_factor / --rotate / --crop handling that inference.py used
+	to apply to its in-memory frame list. Iterating again re-opens the file, so callers
+	can cycle the video when the audio outlasts it.
+	"""
+	def __init__(self, face, resize_factor=1, rotate=False, crop=(0, -1, 0, -1), fps=25.):
+		self.face = face
+		self.resize_factor = resize_factor
+		self.rotate = rotate
+		self.crop = crop
+		self.is_image = face.split('.')[1] in IMAGE_EXTENSIONS
+
+		if self.is_image:
+			self.fps = fps
+		else:
+			video_stream = cv2.VideoCapture(face)
+			self.fps = video_stream.get(cv2.CAP_PROP_FPS)
+			video_stream.release()
+
+	def transform(self, frame):
+		if self.resize_factor > 1:
+			frame = cv2.resize(frame, (frame.shape[1]//self.resize_factor, frame.shape[0]//self.resize_factor))
+
+		if self.rotate:
+			frame = cv2.rotate(frame, cv2.ROTATE_90_CLOCKWISE)
+
+		y1, y2, x1, x2 = self.crop
+		if x2 == -1: x2 = frame.shape[1]
+		if y2 == -1: y2 = frame.shape[0]
+
+		return frame[y1:y2, x1:x2]
+
+	def __iter__(self):
+		if self.is_image:
+			yield cv2.imread(self.face)
+			return
+
+		video_stream = cv2.VideoCapture(self.face)
+		try:
+			while 1:
+				still_reading, frame = video_stream.read()
+				if not still_reading:
+					break
+				yield self.transform(frame)
+		finally:
+			video_stream.release()
+
+class Compositor:
+	"""Writes a source frame with its face ROIs replaced by the Wav2Lip predictions.
+
+	The ROIs are patched in place, the frame is handed to the writer, and the original pixels are
+	put back, so the source frames are never copied (and can be reused for the static / cycled
+	video cases). With `feather` > 0 the patch is blended into the frame over a linear ramp of
+	that many pixels at the ROI border instead of being pasted with a hard edge.
+	"""
+	def __init__(self, feather=0):
+		self.feather = feather
+		self.masks = {}
+
+	def mask(self, h, w):
+		if (h, w) not in self.masks:
+			f = max(1, min(self.feather, h // 2, w // 2))
+			ramp_y = np.clip((np.minimum(np.arange(h), np.arange(h)[::-1]) + 1) / f, 0, 1)
+			ramp_x = np.clip((np.minimum(np.arange(w), np.arange(w)[::-1]) + 1) / f, 0, 1)
+			weights = np.outer(ramp_y, ramp_x).astype(np.float32)
+			self.masks[(h, w)] = (weights, 1 - weights)
+		return self.masks[(h, w)]
+
+	def write(self, out, frame, faces):
+		"""Writes `frame` with each `(coords, pred)` in `faces` pasted at its (y1, y2, x1, x2) box."""
+		originals = []
+		try:
+			for (y1, y2, x1, x2), pred in faces:
+				roi = frame[y1:y2, x1:x2]
+				patch = cv2.resize(pred.astype(np.uint8), (x2 - x1, y2 - y1))
+				if self.feather > 0:
+					weights, inverse = self.mask(y2 - y1, x2 - x1)
+					patch = cv2.blendLinear(patch, roi, weights, inverse)
+
+				originals.append((roi, roi.copy()))
+				roi[...] = patch
+			out.write(frame)
+		finally:
+			for roi, original in reversed(originals):
+				roi[...] = original
+
+def windows(frames, size, limit=None):
+	"""Groups an iterable of frames into lists of at most `size`, stopping after `limit` frames."""
+	window = []
+	for i, frame in enumerate(frames):
+		if limit is not None and i >= limit:
+			break
+		window.append(frame)
+		if len(window) == size:
+			yield window
+			window = []
+	if window:
+		yield window
+
+class FFmpegWriter:
+	"""Encodes BGR frames and muxes them with an audio track in a single ffmpeg process.
+
+	Raw frames go to ffmpeg's stdin, so the video is encoded exactly once (no intermediate
+	AVI) and nothing is written to disk except `outfile`.
+	"""
+	def __init__(self, outfile, audio_path, fps, size, encoder='libx264', preset='medium', threads=0, crf=18):
+		width, height = size
+		command = ['ffmpeg', '-y', '-v', 'error', '-nostdin',
+				'-f', 'rawvideo', '-pix_fmt', 'bgr24', '-s', '{}x{}'.format(width, height), '-r', str(fps), '-i', 'pipe:0',
+				'-i', audio_path,
+				'-map', '0:v:0', '-map', '1:a:0',
+				'-c:v', encoder, '-threads', str(threads)]
+		if preset:
+			command += ['-preset', preset]
+		if crf is not None and encoder in ('libx264', 'libx265'):
+			command += ['-crf', str(crf)]
+		# yuv420p (and even dimensions) keeps the H.264 output playable everywhere.
+		command += ['-pix_fmt', 'yuv420p', '-vf', 'pad=ceil(iw/2)*2:ceil(ih/2)*2',
+				'-c:a', 'aac', outfile]
+
+		self.outfile = outfile
+		self.process = subprocess.Popen(command, stdin=subprocess.PIPE)
+
+	def write(self, frame):
+		try:
+			self.process.stdin.write(memoryview(frame if frame.flags.c_contiguous else frame.copy()))
+		except BrokenPipeError:
+			self.close()
+
+	def close(self):
+		if self.process.stdin and not self.process.stdin.closed:
+			try:
+				self.process.stdin.close()
+			except BrokenPipeError:
+				pass
+		if self.process.wait() != 0:
+			raise RuntimeError('ffmpeg failed to write {} (return code {})'.format(self.outfile, self.process.returncode))
+
+	def abort(self):
+		"""Stops ffmpeg without finishing the file and removes the truncated `outfile`."""
+		self.process.kill()
+		self.process.wait()
+		if self.process.stdin and not self.process.stdin.closed:
+			try:
+				self.process.stdin.close()
+			except BrokenPipeError:
+				pass
+		if os.path.exists(self.outfile):
+			os.remove(self.outfile)
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc, tb):
+		if exc_type is None:
+			self.close()
+		else:
+			self.abort()